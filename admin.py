@@ -1,11 +1,23 @@
 import sqlite3
+import threading
+import queue
+import time
 import tkinter as tk
 from tkinter import ttk
 from datetime import datetime, timedelta
 
 DB_PATH = "words.db"
-REFRESH_INTERVAL = 5000  # Оновлення кожні 5 сек
+REFRESH_INTERVAL = 5000  # Повне перечитування не частіше, ніж раз на 5 сек (мс)
+CHECK_INTERVAL = 1.0  # Як часто фоновий потік перевіряє, чи змінилась БД (сек)
+ACTIVE_RECHECK = 60  # Перерахунок статусу "активний" навіть без змін у БД (сек)
+POLL_INTERVAL = 100  # Як часто інтерфейс забирає результати з фонового потоку (мс)
 ACTIVE_THRESHOLD_MINUTES = 5
+PAGE_SIZE = 100  # Скільки рядків таблиці завантажувати за раз
+
+# Колонка таблиці -> колонка БД. Сортування лише за цими (проіндексованими) колонками
+USERS_SORT = {"id": "user_id", "name": "username", "date": "start_date", "active": "last_active",
+              "score": "best_score"}
+WORDS_SORT = {"word": "word", "trans": "translation", "lang": "language", "usage": "usage_count"}
 
 
 def fix_db():
@@ -20,10 +32,197 @@ def fix_db():
         cursor.execute("ALTER TABLE users ADD COLUMN best_score INTEGER DEFAULT 0")
     except:
         pass
+    # Індекси для сортування сторінками в SQL
+    try:
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_last_active ON users(last_active)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_start_date ON users(start_date)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_best_score ON users(best_score)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_words_translation ON user_words(user_id, translation)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_words_language ON user_words(user_id, language)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_words_usage ON user_words(user_id, usage_count)")
+    except sqlite3.OperationalError:
+        pass  # таблиць ще немає - їх створить бот
     conn.commit()
     conn.close()
 
 
+# Параметри сторінки таблиці: сортування, пошук, номер сторінки
+def new_view(sort, desc=False):
+    return {"sort": sort, "desc": desc, "search": "", "page": 0}
+
+
+# Фоновий потік читання БД: тримає одне з'єднання лише для читання і перечитує поточні сторінки
+# тільки коли PRAGMA data_version показує, що хтось (бот) записав зміни, або змінились параметри перегляду.
+# Результати передаються в інтерфейс через чергу, сам Tk з цього потоку не чіпаємо.
+class DbReader(threading.Thread):
+    def __init__(self, results):
+        super().__init__(daemon=True)
+        self.results = results
+        self.requests = queue.Queue()
+        self.stopped = threading.Event()
+        self.selected_user_id = None
+        # За замовчуванням спочатку ті, хто був активний нещодавно
+        self.users_view = new_view("active", desc=True)
+        self.words_view = new_view("word")
+
+    def request(self, **changes):
+        # changes: users_view=..., words_view=..., uid=...
+        self.requests.put(changes)
+
+    def stop(self):
+        self.stopped.set()
+        self.requests.put(None)
+
+    def run(self):
+        conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, timeout=5)
+        conn.execute("PRAGMA busy_timeout=5000")
+        last_version = None
+        last_full = 0
+        while not self.stopped.is_set():
+            try:
+                changes = self.requests.get(timeout=CHECK_INTERVAL)
+                if self.stopped.is_set():
+                    break
+                try:
+                    # Перечитуємо одразу лише те, що змінилось
+                    if "users_view" in changes:
+                        self.users_view = changes["users_view"]
+                        self.results.put(("users", self.read_users(conn)))
+                    if "uid" in changes or "words_view" in changes:
+                        self.selected_user_id = changes.get("uid", self.selected_user_id)
+                        self.words_view = changes.get("words_view", self.words_view)
+                        uid = self.selected_user_id
+                        self.results.put(("details", uid, self.read_details(conn, uid)))
+                except sqlite3.Error as e:
+                    print(f"Помилка читання БД: {e}")
+                continue
+            except queue.Empty:
+                pass
+
+            try:
+                version = conn.execute("PRAGMA data_version").fetchone()[0]
+                now = time.monotonic()
+                changed = version != last_version
+                if not changed and now - last_full < ACTIVE_RECHECK:
+                    continue
+                if changed and now - last_full < REFRESH_INTERVAL / 1000:
+                    continue
+                last_version, last_full = version, now
+
+                self.results.put(("users", self.read_users(conn)))
+                if self.selected_user_id is not None:
+                    uid = self.selected_user_id
+                    self.results.put(("details", uid, self.read_details(conn, uid)))
+            except sqlite3.Error as e:
+                print(f"Помилка читання БД: {e}")
+        conn.close()
+
+    @staticmethod
+    def read_page(conn, view, columns, sort_map, table, where, params):
+        # Одна сторінка з сортуванням і фільтром в SQL; якщо сторінка вийшла за межі - остання сторінка
+        total = conn.execute(f"SELECT COUNT(*) FROM {table} WHERE {where}", params).fetchone()[0]
+        last_page = max(0, (total - 1) // PAGE_SIZE)
+        if view["page"] > last_page:
+            view["page"] = last_page
+        # rowid в тому ж напрямку - стабільний порядок при однакових значеннях, індекс при цьому працює
+        direction = "DESC" if view["desc"] else "ASC"
+        order = f"{sort_map[view['sort']]} {direction}, rowid {direction}"
+        rows = conn.execute(
+            f"SELECT {columns} FROM {table} WHERE {where} ORDER BY {order} LIMIT ? OFFSET ?",
+            (*params, PAGE_SIZE, view["page"] * PAGE_SIZE)).fetchall()
+        return rows, total
+
+    def read_users(self, conn):
+        view = dict(self.users_view)
+        where, params = "1", ()
+        search = view["search"]
+        if search:
+            if search.isdigit():
+                where, params = "(user_id=? OR username LIKE ?)", (int(search), f"%{search}%")
+            else:
+                where, params = "username LIKE ?", (f"%{search}%",)
+        users, total = self.read_page(conn, view, "user_id, username, start_date, last_active, best_score",
+                                      USERS_SORT, "users", where, params)
+
+        now = datetime.now()
+        rows = []
+        for u in users:
+            active = False
+            if u[3]:
+                try:
+                    dt = datetime.fromisoformat(u[3])
+                    if now - dt < timedelta(minutes=ACTIVE_THRESHOLD_MINUTES): active = True
+                except:
+                    pass
+            rows.append((active, u))
+        return rows, total, view
+
+    def read_details(self, conn, uid):
+        cur = conn.cursor()
+
+        # 1. Статистика по мовах (готові агрегати, які бот підтримує тригерами)
+        try:
+            cur.execute("SELECT language, word_count, total_xp FROM user_stats WHERE user_id=? AND word_count > 0",
+                        (uid,))
+        except sqlite3.OperationalError:
+            # Стара база, бот ще не створив user_stats
+            cur.execute("""
+                SELECT COALESCE(language, ''), COUNT(*), SUM(usage_count) 
+                FROM user_words 
+                WHERE user_id=? 
+                GROUP BY COALESCE(language, '')
+            """, (uid,))
+        stats = []
+        for lang, count, xp in cur.fetchall():
+            xp = xp or 0
+            lvl = (xp // 10) + 1
+            stats.append((lang, count, xp, f"Lvl {lvl}"))
+
+        # 2. Сторінка слів
+        view = dict(self.words_view)
+        where, params = "user_id=?", (uid,)
+        if view["search"]:
+            where += " AND (word LIKE ? OR translation LIKE ?)"
+            params += (f"%{view['search']}%",) * 2
+        words, total = self.read_page(conn, view, "word, translation, language, usage_count",
+                                      WORDS_SORT, "user_words", where, params)
+
+        # 3. Заголовок
+        cur.execute("SELECT username, best_score FROM users WHERE user_id=?", (uid,))
+        header = cur.fetchone()
+        return header, stats, (words, total, view)
+
+
+# Оновлює Treeview за новим списком рядків: змінює лише ті рядки, що відрізняються.
+# rows: [(iid, values, tags)] у потрібному порядку
+rendered = {}  # таблиця -> {iid: (values, tags)}, що зараз показано
+
+
+def apply_rows(tree, rows):
+    shown = rendered.setdefault(str(tree), {})
+    new_ids = [iid for iid, _, _ in rows]
+    keep = set(new_ids)
+    stale = [iid for iid in shown if iid not in keep]
+    if stale:
+        tree.delete(*stale)
+        for iid in stale:
+            del shown[iid]
+
+    for iid, values, tags in rows:
+        values = tuple("" if v is None else str(v) for v in values)
+        if iid not in shown:
+            tree.insert('', tk.END, iid=iid, values=values, tags=tags)
+        elif shown[iid] != (values, tags):
+            tree.item(iid, values=values, tags=tags)
+        shown[iid] = (values, tags)
+
+    # Переставляємо рядки лише якщо змінився порядок
+    if list(tree.get_children('')) != new_ids:
+        for index, iid in enumerate(new_ids):
+            tree.move(iid, '', index)
+
+
 class AdminApp(tk.Tk):
     def __init__(self):
         super().__init__()
@@ -35,19 +234,26 @@ class AdminApp(tk.Tk):
         style.configure("Treeview.Heading", font=("Arial", 10, "bold"))
         style.configure("Treeview", font=("Arial", 10), rowheight=25)
 
+        # Читання БД - у фоновому потоці, інтерфейс лише забирає готові результати
+        self.results = queue.Queue()
+        self.reader = DbReader(self.results)
+        self.users_view = dict(self.reader.users_view)
+        self.words_view = dict(self.reader.words_view)
+
         # --- 1. КОРИСТУВАЧІ ---
         frame_users = tk.LabelFrame(self, text="Користувачі")
         frame_users.pack(fill=tk.X, padx=10, pady=5)
 
+        self.users_search, self.users_page = self.make_toolbar(frame_users, "users")
+
         self.users_tree = ttk.Treeview(frame_users, columns=("id", "name", "date", "active", "score"), show="headings",
                                        height=6)
 
-        # Налаштування колонок з сортуванням
+        # Налаштування колонок з сортуванням (сортує БД)
         cols_users = {"id": "ID", "name": "Юзернейм", "date": "Реєстрація", "active": "Активність",
                       "score": "Рекорд гри"}
         for col, name in cols_users.items():
-            self.users_tree.heading(col, text=name,
-                                    command=lambda c=col: self.sort_by_column(self.users_tree, c, False))
+            self.users_tree.heading(col, text=name, command=lambda c=col: self.sort_view("users", c))
             self.users_tree.column(col, anchor="center")
 
         self.users_tree.pack(fill=tk.X, padx=5, pady=5)
@@ -75,104 +281,126 @@ class AdminApp(tk.Tk):
         frame_words = tk.LabelFrame(self, text="Словник користувача")
         frame_words.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
 
+        self.words_search, self.words_page = self.make_toolbar(frame_words, "words")
+
         self.words_tree = ttk.Treeview(frame_words, columns=("word", "trans", "lang", "usage"), show="headings")
 
         cols_words = {"word": "Слово", "trans": "Переклад", "lang": "Мова", "usage": "Успішність"}
         for col, name in cols_words.items():
-            self.words_tree.heading(col, text=name,
-                                    command=lambda c=col: self.sort_by_column(self.words_tree, c, False))
+            self.words_tree.heading(col, text=name, command=lambda c=col: self.sort_view("words", c))
             self.words_tree.column(col, anchor="center")
 
         self.words_tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
 
-        # Змінні
-        self.selected_user_id = None
-        self.update_users_table()
-
-    def update_users_table(self):
-        # Зберігаємо виділення
-        sel = self.users_tree.selection()
-        sel_id = self.users_tree.item(sel[0])['values'][0] if sel else None
-
-        # Очищення
-        for row in self.users_tree.get_children(): self.users_tree.delete(row)
-
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id, username, start_date, last_active, best_score FROM users")
-        users = cursor.fetchall()
-        conn.close()
-
-        now = datetime.now()
-        rows = []
-        for u in users:
-            active = False
-            if u[3]:
-                try:
-                    dt = datetime.fromisoformat(u[3])
-                    if now - dt < timedelta(minutes=ACTIVE_THRESHOLD_MINUTES): active = True
-                except:
-                    pass
-            rows.append((active, u))
-
-        # Сортуємо: спочатку активні
-        rows.sort(key=lambda x: (not x[0], x[1][0]))
-
-        for active, u in rows:
-            tag = "active" if active else ""
-            item = self.users_tree.insert("", tk.END, values=u, tags=(tag,))
-            if sel_id and u[0] == sel_id: self.users_tree.selection_set(item)
-
         self.users_tree.tag_configure("active", background="#d1ffc4")  # Зелений для активних
 
-        # Оновлюємо деталі, якщо хтось вибраний
-        if self.selected_user_id:
-            self.update_details(self.selected_user_id)
-
-        self.after(REFRESH_INTERVAL, self.update_users_table)
-
-    def update_details(self, uid):
-        # Запам'ятовуємо сортування, якщо воно було (не реалізовано для простоти, але дані оновляться)
-        for t in (self.stats_tree, self.words_tree):
-            for r in t.get_children(): t.delete(r)
-
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-
-        # 1. Оновлення статистики по мовах
-        cur.execute("""
-            SELECT language, COUNT(*), SUM(usage_count) 
-            FROM user_words 
-            WHERE user_id=? 
-            GROUP BY language
-        """, (uid,))
-
-        for lang, count, xp in cur.fetchall():
-            xp = xp or 0
-            lvl = (xp // 10) + 1
-            self.stats_tree.insert("", tk.END, values=(lang, count, xp, f"Lvl {lvl}"))
-
-        # 2. Оновлення слів
-        cur.execute("SELECT word, translation, language, usage_count FROM user_words WHERE user_id=?", (uid,))
-        for w in cur.fetchall():
-            self.words_tree.insert("", tk.END, values=w)
-
-        # 3. Заголовок
-        cur.execute("SELECT username, best_score FROM users WHERE user_id=?", (uid,))
-        data = cur.fetchone()
-        if data:
-            self.lbl_selected.config(text=f"👤 {data[0]} (ID: {uid}) | 🎮 Рекорд: {data[1]}")
+        # Змінні
+        self.selected_user_id = None
 
-        conn.close()
+        self.reader.start()
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.after(POLL_INTERVAL, self.process_results)
+
+    def make_toolbar(self, parent, name):
+        # Рядок пошуку та перемикання сторінок над таблицею
+        bar = tk.Frame(parent)
+        bar.pack(fill=tk.X, padx=5, pady=(5, 0))
+
+        search = tk.StringVar()
+        entry = tk.Entry(bar, textvariable=search, width=30)
+        entry.pack(side=tk.LEFT)
+        entry.bind("<Return>", lambda e: self.search_view(name))
+        tk.Button(bar, text="🔍 Пошук", command=lambda: self.search_view(name)).pack(side=tk.LEFT, padx=5)
+
+        page = tk.Label(bar, text="")
+        tk.Button(bar, text="▶", command=lambda: self.change_page(name, 1)).pack(side=tk.RIGHT)
+        page.pack(side=tk.RIGHT, padx=5)
+        tk.Button(bar, text="◀", command=lambda: self.change_page(name, -1)).pack(side=tk.RIGHT)
+        return search, page
+
+    def get_view(self, name):
+        return self.users_view if name == "users" else self.words_view
+
+    def send_view(self, name):
+        if name == "users":
+            self.reader.request(users_view=dict(self.users_view))
+        elif self.selected_user_id is not None:
+            self.reader.request(words_view=dict(self.words_view))
+
+    def sort_view(self, name, col):
+        # Повторний клік по тій самій колонці змінює напрямок
+        view = self.get_view(name)
+        view["desc"] = not view["desc"] if view["sort"] == col else False
+        view["sort"] = col
+        view["page"] = 0
+        self.send_view(name)
+
+    def search_view(self, name):
+        view = self.get_view(name)
+        view["search"] = (self.users_search if name == "users" else self.words_search).get().strip()
+        view["page"] = 0
+        self.send_view(name)
+
+    def change_page(self, name, delta):
+        view = self.get_view(name)
+        view["page"] = max(0, view["page"] + delta)
+        self.send_view(name)
+
+    @staticmethod
+    def page_text(view, total):
+        start = view["page"] * PAGE_SIZE
+        if not total:
+            return "0 з 0"
+        return f"{start + 1}–{min(start + PAGE_SIZE, total)} з {total}"
+
+    def process_results(self):
+        try:
+            while True:
+                item = self.results.get_nowait()
+                if item[0] == "users":
+                    self.update_users_table(*item[1])
+                elif item[0] == "details" and item[1] == self.selected_user_id:
+                    self.update_details(item[1], *item[2])
+        except queue.Empty:
+            pass
+        self.after(POLL_INTERVAL, self.process_results)
+
+    def update_users_table(self, users, total, view):
+        # Сторінку могли скоригувати (наприклад, після пошуку рядків стало менше)
+        self.users_view["page"] = view["page"]
+        self.users_page.config(text=self.page_text(view, total))
+        rows = [(str(u[0]), u, ("active",) if active else ()) for active, u in users]
+        apply_rows(self.users_tree, rows)
+
+    def update_details(self, uid, header, stats, words_page):
+        words, total, view = words_page
+        self.words_view["page"] = view["page"]
+        self.words_page.config(text=self.page_text(view, total))
+        # iid "" - це корінь Treeview, тому мова без назви теж отримує непорожній ідентифікатор
+        apply_rows(self.stats_tree, [(f"lang:{s[0]}", s, ()) for s in stats])
+        apply_rows(self.words_tree, [(f"{w[2]}:{w[0]}", w, ()) for w in words])
+
+        if header:
+            self.lbl_selected.config(text=f"👤 {header[0]} (ID: {uid}) | 🎮 Рекорд: {header[1]}")
 
     def on_user_select(self, event):
         sel = self.users_tree.selection()
         if sel:
-            self.selected_user_id = self.users_tree.item(sel[0])["values"][0]
-            self.update_details(self.selected_user_id)
+            uid = int(sel[0])
+            if uid != self.selected_user_id:
+                self.selected_user_id = uid
+                # Новий користувач - словник з першої сторінки, пошук по словах скидаємо
+                self.words_view["page"] = 0
+                self.words_view["search"] = ""
+                self.words_search.set("")
+                self.reader.request(uid=uid, words_view=dict(self.words_view))
+
+    def on_close(self):
+        self.reader.stop()
+        self.destroy()
 
     def sort_by_column(self, tree, col, reverse):
-        """Універсальна функція сортування для будь-якої таблиці"""
+        """Сортування невеликої таблиці в пам'яті (статистика по мовах)"""
         l = [(tree.set(k, col), k) for k in tree.get_children('')]
 
         # Пробуємо сортувати як числа, якщо не вийде - як текст
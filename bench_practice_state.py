@@ -0,0 +1,62 @@
+import json
+import random
+import string
+import sys
+import tracemalloc
+
+# Порівняння стану практики в FSM: повні рядки словника проти ключів (word, language) + курсор
+SIZES = (100, 1000, 10000)
+SESSION_SIZE = 10
+
+
+def rand_text(n):
+    return "".join(random.choices(string.ascii_lowercase, k=n))
+
+
+def make_dictionary(size):
+    # Той самий набір полів, що й у user_words: word, translation, language, usage_count, image_url, association, transcription
+    return [
+        (rand_text(8), rand_text(10), "en", random.randint(0, 20),
+         f"https://pixabay.com/get/{rand_text(40)}.jpg",
+         f"Асоціація: {rand_text(60)}", f"[{rand_text(8)}]")
+        for _ in range(size)
+    ]
+
+
+def full_state(words):
+    # Старий варіант: увесь словник + копії рядків для сесії
+    plist = random.sample(words, min(SESSION_SIZE, len(words)))
+    return {"all_practice_words": words, "plist": plist, "pidx": 0}
+
+
+def compact_state(words):
+    # Новий варіант: лише ключі слів сесії та позиція
+    plist = [[w[0], w[2]] for w in random.sample(words, min(SESSION_SIZE, len(words)))]
+    return {"plist": plist, "pidx": 0}
+
+
+def measure(build, words):
+    # Пам'ять, що виділяється під стан (рядки словника вже існують - як у MemoryStorage після fetchall)
+    tracemalloc.start()
+    state = build(words)
+    # MemoryStorage зберігає копію словника стану, persistent-сховища - серіалізований JSON
+    stored = json.loads(json.dumps(state))
+    mem = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    serialized = len(json.dumps(state, ensure_ascii=False).encode())
+    del stored
+    return mem, serialized
+
+
+def main():
+    random.seed(1)
+    print(f"{'слів':>8} | {'повні рядки, RAM':>17} | {'JSON':>12} | {'ключі, RAM':>11} | {'JSON':>8}")
+    for size in SIZES:
+        words = make_dictionary(size)
+        full_mem, full_json = measure(full_state, words)
+        compact_mem, compact_json = measure(compact_state, words)
+        print(f"{size:>8} | {full_mem:>15} B | {full_json:>10} B | {compact_mem:>9} B | {compact_json:>6} B")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,22 +1,43 @@
 import asyncio
 import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import json
+import hashlib
+import functools
+import math
+import multiprocessing
+import signal
+from queue import Empty, Full
+import html
+from collections import deque
 import urllib.parse
-from datetime import datetime
+import gzip
+from datetime import datetime, timedelta
 from aiogram import Bot, Dispatcher, Router, types, BaseMiddleware, F
-from aiogram.filters import Command, CommandObject
+from aiogram.filters import Command, CommandObject, ExceptionTypeFilter
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiogram.utils.web_app import safe_parse_webapp_init_data
+from aiogram.dispatcher.flags import get_flag
 from deep_translator import GoogleTranslator
 import random
 import google.genai as genai
 from google.genai import types as genai_types
-from cachetools import TTLCache
+from cachetools import TTLCache, LRUCache
 from typing import Any, Awaitable, Callable, Dict
 import aiohttp
 from aiohttp import web
 import os
 from dotenv import load_dotenv
+
+try:
+    import redis.asyncio as redis  # необов'язково: лише для RATE_LIMIT_BACKEND=redis
+except ImportError:
+    redis = None
 from typing import Dict, Any
 
 def load_config_from_env(env_file: str = ".env") -> Dict[str, Any]:
@@ -28,6 +49,23 @@ def load_config_from_env(env_file: str = ".env") -> Dict[str, Any]:
     config["TELEGRAM_BOT_TOKEN"] = os.getenv("TELEGRAM_BOT_TOKEN", "")
     config["PIXABAY_API_KEY"] = os.getenv("PIXABAY_API_KEY", "")
     config["WEB_APP_URL"] = os.getenv("WEB_APP_URL", "")
+    # Ліміт запитів на хвилину для одного ключа Gemini
+    config["GEMINI_RPM"] = int(os.getenv("GEMINI_RPM", "10") or 10)
+    # Скільки записів кешу ШІ підвантажити в пам'ять при старті (0 - не підвантажувати)
+    config["WORD_INFO_WARMUP"] = int(os.getenv("WORD_INFO_WARMUP", "0") or 0)
+    # Режим вебхука: якщо WEBHOOK_URL порожній - бот працює через поллінг
+    config["WEBHOOK_URL"] = os.getenv("WEBHOOK_URL", "").rstrip("/")
+    config["WEBHOOK_PATH"] = os.getenv("WEBHOOK_PATH", "/webhook")
+    config["WEBHOOK_SECRET"] = os.getenv("WEBHOOK_SECRET", "")
+    config["WEBHOOK_WORKERS"] = int(os.getenv("WEBHOOK_WORKERS", "16") or 16)
+    config["WEBHOOK_QUEUE_SIZE"] = int(os.getenv("WEBHOOK_QUEUE_SIZE", "100") or 100)
+    # Де зберігати лічильники антиспаму: memory, sqlite або redis
+    config["RATE_LIMIT_BACKEND"] = os.getenv("RATE_LIMIT_BACKEND", "memory").lower()
+    config["REDIS_URL"] = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+    # Публічна адреса веб-сервера бота, з якої Web App бере колоду (за замовчуванням - адреса вебхука)
+    config["PUBLIC_URL"] = (os.getenv("PUBLIC_URL") or os.getenv("WEBHOOK_URL", "")).rstrip("/")
+    # Кількість процесів-обробників (1 - усе в одному процесі, як раніше)
+    config["BOT_WORKERS"] = int(os.getenv("BOT_WORKERS", "1") or 1)
 
     gemini_keys_str = os.getenv("GEMINI_API_KEYS")
     
@@ -46,11 +84,24 @@ TELEGRAM_BOT_TOKEN = config["TELEGRAM_BOT_TOKEN"]
 PIXABAY_API_KEY = config["PIXABAY_API_KEY"]
 WEB_APP_URL = config["WEB_APP_URL"]
 GEMINI_API_KEYS = config["GEMINI_API_KEYS"]
+WORD_INFO_WARMUP = config["WORD_INFO_WARMUP"]
+GEMINI_RPM = config["GEMINI_RPM"]
+WEBHOOK_URL = config["WEBHOOK_URL"]
+WEBHOOK_PATH = config["WEBHOOK_PATH"]
+# Якщо секрет не задано, виводимо його з токена (однаковий для всіх реплік)
+WEBHOOK_SECRET = config["WEBHOOK_SECRET"] or hashlib.sha256(TELEGRAM_BOT_TOKEN.encode()).hexdigest()
+WEBHOOK_WORKERS = config["WEBHOOK_WORKERS"]
+WEBHOOK_QUEUE_SIZE = config["WEBHOOK_QUEUE_SIZE"]
+BOT_WORKERS = config["BOT_WORKERS"]
+RATE_LIMIT_BACKEND = config["RATE_LIMIT_BACKEND"]
+REDIS_URL = config["REDIS_URL"]
+PUBLIC_URL = config["PUBLIC_URL"]
 
 # Перевірка завантажених даних
 print("✅ Конфігурація успішно завантажена:")
 print(f"TELEGRAM_BOT_TOKEN: {TELEGRAM_BOT_TOKEN[:8]}...") 
 print(f"WEB_APP_URL: {WEB_APP_URL}")
+print(f"Режим: {'вебхук ' + WEBHOOK_URL + WEBHOOK_PATH if WEBHOOK_URL else 'поллінг'}")
 print(f"Кількість завантажених Gemini ключів: {len(GEMINI_API_KEYS)}")
 print(f"Перший ключ Gemini: {GEMINI_API_KEYS[0][:8]}..." if GEMINI_API_KEYS else "Ключі Gemini відсутні.")
 
@@ -58,40 +109,356 @@ print(f"Перший ключ Gemini: {GEMINI_API_KEYS[0][:8]}..." if GEMINI_API
 # Це необхідно для уникнення помилки "bound to a different event loop"
 router = Router()
 
-# Підключення до бази даних та створення курсору
-conn = sqlite3.connect("words.db")
-cursor = conn.cursor()
-
-# Створення таблиці користувачів, якщо вона не існує
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS users (
-    user_id INTEGER PRIMARY KEY,
-    username TEXT,
-    start_date TEXT,
-    last_active TEXT,
-    best_score INTEGER DEFAULT 0
-)
-""")
-
-# Створення таблиці слів користувачів, якщо вона не існує
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS user_words (
-    user_id INTEGER,
-    word TEXT,
-    translation TEXT,
-    language TEXT,
-    usage_count INTEGER DEFAULT 0,
-    image_url TEXT,
-    association TEXT,
-    transcription TEXT,
-    PRIMARY KEY(user_id, word, language)
-)
-""")
-conn.commit()
+
+# МЕТРИКИ (текстовий формат Prometheus, без сторонніх бібліотек)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def format_labels(names, values, extra=""):
+    pairs = ['%s="%s"' % (n, str(v).replace("\\", "\\\\").replace('"', '\\"')) for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_values, value in self.values.items():
+            lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}  # label_values -> [лічильники по кошиках..., сума, кількість]
+
+    def observe(self, value, *label_values):
+        series = self.values.get(label_values)
+        if series is None:
+            series = self.values[label_values] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, series in self.values.items():
+            labels = format_labels(self.labels, label_values)
+            for bound, count in zip(self.buckets, series):
+                le = format_labels(self.labels, label_values, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{le} {count}")
+            le = format_labels(self.labels, label_values, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {series[-1]}")
+            lines.append(f"{self.name}_sum{labels} {round(series[-2], 6)}")
+            lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+
+# Значення, що зчитуються з компонентів у момент запиту /metrics
+# (fn повертає число або словник {значення_міток: число})
+class Collected:
+    def __init__(self, name, help_text, kind, fn, labels=()):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.fn = fn
+        self.labels = labels
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            value = self.fn()
+        except Exception as e:
+            print(f"Metrics error ({self.name}): {e}")
+            return []
+        if isinstance(value, dict):
+            for label_values, v in value.items():
+                if not isinstance(label_values, tuple):
+                    label_values = (label_values,)
+                lines.append(f"{self.name}{format_labels(self.labels, label_values)} {v}")
+        else:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help_text, labels=()):
+        return self._add(Counter(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help_text, labels, buckets))
+
+    def collect(self, name, help_text, kind, fn, labels=()):
+        return self._add(Collected(name, help_text, kind, fn, labels))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+HANDLER_LATENCY = metrics.histogram("bot_handler_duration_seconds", "Час виконання обробника", ("handler",))
+HANDLER_ERRORS = metrics.counter("bot_handler_errors_total", "Помилки в обробниках", ("handler",))
+UPSTREAM_LATENCY = metrics.histogram("bot_upstream_duration_seconds", "Час запиту до зовнішнього сервісу", ("upstream",))
+UPSTREAM_ERRORS = metrics.counter("bot_upstream_errors_total", "Помилки зовнішніх сервісів", ("upstream",))
+UPSTREAM_QUEUE_WAIT = metrics.histogram("bot_upstream_queue_wait_seconds", "Очікування в черзі до сервісу", ("upstream",))
+UPSTREAM_REJECTED = metrics.counter("bot_upstream_rejected_total", "Запити, відхилені через перевантаження",
+                                    ("upstream", "reason"))
+DB_LATENCY = metrics.histogram("bot_db_duration_seconds", "Час операції з БД (разом з чергою до потоку)", ("kind",))
+DB_ERRORS = metrics.counter("bot_db_errors_total", "Помилки SQLite", ("kind",))
+LOOP_LAG = metrics.histogram("bot_event_loop_lag_seconds", "Затримка циклу подій",
+                             buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+
+LOOP_LAG_INTERVAL = 0.5  # секунд між вимірами затримки циклу подій
+
+
+# Наскільки пізніше запланованого прокидається цикл подій (довгі синхронні ділянки коду)
+async def loop_lag_monitor():
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        LOOP_LAG.observe(max(0.0, loop.time() - started - LOOP_LAG_INTERVAL))
+
+
+DB_PATH = "words.db"
+DB_READERS = 4  # Кількість з'єднань для читання
+SQL_VARS_CHUNK = 900  # SQLite обмежує кількість параметрів у запиті
+
+
+# Створення таблиць та міграції (виконується один раз при старті, до запуску циклу подій)
+def init_db(path=DB_PATH):
+    conn = sqlite3.connect(path)
+    # WAL дозволяє читачам працювати паралельно з записувачем
+    conn.execute("PRAGMA journal_mode=WAL")
+    cursor = conn.cursor()
+
+    # Створення таблиці користувачів, якщо вона не існує
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        start_date TEXT,
+        last_active TEXT,
+        best_score INTEGER DEFAULT 0
+    )
+    """)
+
+    # Створення таблиці слів користувачів, якщо вона не існує
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS user_words (
+        user_id INTEGER,
+        word TEXT,
+        translation TEXT,
+        language TEXT,
+        usage_count INTEGER DEFAULT 0,
+        image_url TEXT,
+        association TEXT,
+        transcription TEXT,
+        PRIMARY KEY(user_id, word, language)
+    )
+    """)
+    conn.commit()
+
+    # Зіграні ігри (захист від повторної обробки того самого результату)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS game_results (
+        user_id INTEGER,
+        game_id TEXT,
+        score INTEGER,
+        learned_count INTEGER DEFAULT 0,
+        created_at TEXT,
+        PRIMARY KEY(user_id, game_id)
+    )
+    """)
+    conn.commit()
+
+    # Спільний кеш відповідей ШІ для get_full_word_info
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS word_info_cache (
+        word_norm TEXT,
+        language TEXT,
+        translation_norm TEXT,
+        prompt_version TEXT,
+        transcription TEXT,
+        association TEXT,
+        visual_prompt TEXT,
+        created_at TEXT,
+        PRIMARY KEY(word_norm, language, translation_norm)
+    )
+    """)
+    conn.commit()
+
+    # Кеш перекладів (word, language) -> translation
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS translation_cache (
+        word_norm TEXT,
+        language TEXT,
+        translation TEXT,
+        created_at TEXT,
+        PRIMARY KEY(word_norm, language)
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_translation_cache_created ON translation_cache(created_at)")
+    conn.commit()
+
+    # Пул готових кандидатів для "Слова дня"
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS wod_pool (
+        language TEXT,
+        level TEXT,
+        word_norm TEXT,
+        word TEXT,
+        translation TEXT,
+        transcription TEXT,
+        association TEXT,
+        image_url TEXT,
+        img_query TEXT,
+        created_at TEXT,
+        PRIMARY KEY(language, level, word_norm)
+    )
+    """)
+    conn.commit()
+
+    # Стани FSM (переживають перезапуск бота; процеси бачать їх у спільному файлі, але кешують у пам'яті -
+    # див. SQLiteStorage: кожного користувача має обслуговувати один процес)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS fsm_states (
+        key TEXT PRIMARY KEY,
+        state TEXT,
+        data TEXT,
+        updated_at REAL
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states(updated_at)")
+    conn.commit()
+
+    # Лічильники антиспаму (token bucket), якщо RATE_LIMIT_BACKEND=sqlite
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS rate_buckets (
+        key TEXT PRIMARY KEY,
+        tokens REAL,
+        updated REAL
+    )
+    """)
+    conn.commit()
+
+    migrate_db(cursor)
+
+    # Індекс для вибірки найменш вивчених слів (клавіатура з грою)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_words_usage ON user_words(user_id, usage_count)")
+    # Індекс для перевірки "чи є слово у словнику" без урахування регістру (слово дня)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_words_lower ON user_words(user_id, language, lower(word))")
+    # Черга слів до повторення: по одній мові та по всіх мовах
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_words_due ON user_words(user_id, language, due_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_words_due_all ON user_words(user_id, due_at)")
+    # Очищення старих записів про зіграні ігри
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_game_results_created ON game_results(created_at)")
+    conn.commit()
+
+    init_user_stats(conn)
+    conn.close()
+
+
+# Агрегати по користувачу і мові (кількість слів, XP, остання практика), які підтримують тригери.
+# /stats, рівень і адмінка читають один короткий рядок замість усього словника.
+# BEGIN IMMEDIATE - щоб при старті кількох процесів заповнення з user_words виконалось рівно один раз
+USER_STATS_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS user_stats_insert AFTER INSERT ON user_words BEGIN
+        INSERT INTO user_stats (user_id, language, word_count, total_xp)
+        VALUES (NEW.user_id, COALESCE(NEW.language, ''), 1, COALESCE(NEW.usage_count, 0))
+        ON CONFLICT(user_id, language) DO UPDATE SET
+            word_count = word_count + 1, total_xp = total_xp + excluded.total_xp;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS user_stats_delete AFTER DELETE ON user_words BEGIN
+        UPDATE user_stats SET word_count = word_count - 1, total_xp = total_xp - COALESCE(OLD.usage_count, 0)
+        WHERE user_id = OLD.user_id AND language = COALESCE(OLD.language, '');
+        DELETE FROM user_stats
+        WHERE user_id = OLD.user_id AND language = COALESCE(OLD.language, '') AND word_count <= 0;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS user_stats_update AFTER UPDATE OF usage_count, language ON user_words
+    WHEN OLD.usage_count IS NOT NEW.usage_count OR OLD.language IS NOT NEW.language BEGIN
+        UPDATE user_stats SET word_count = word_count - 1, total_xp = total_xp - COALESCE(OLD.usage_count, 0)
+        WHERE user_id = OLD.user_id AND language = COALESCE(OLD.language, '');
+        INSERT INTO user_stats (user_id, language, word_count, total_xp)
+        VALUES (NEW.user_id, COALESCE(NEW.language, ''), 1, COALESCE(NEW.usage_count, 0))
+        ON CONFLICT(user_id, language) DO UPDATE SET
+            word_count = word_count + 1, total_xp = total_xp + excluded.total_xp;
+        DELETE FROM user_stats
+        WHERE user_id = OLD.user_id AND language = COALESCE(OLD.language, '') AND word_count <= 0;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS user_stats_practiced AFTER UPDATE OF usage_count, reps ON user_words
+    WHEN NEW.usage_count > OLD.usage_count OR NEW.reps IS NOT OLD.reps BEGIN
+        UPDATE user_stats SET last_practiced = strftime('%Y-%m-%dT%H:%M:%f', 'now', 'localtime')
+        WHERE user_id = NEW.user_id AND language = COALESCE(NEW.language, '');
+    END
+    """,
+]
+
+
+def init_user_stats(conn):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='user_stats'").fetchone()
+        if not exists:
+            conn.execute("""
+            CREATE TABLE user_stats (
+                user_id INTEGER,
+                language TEXT,
+                word_count INTEGER DEFAULT 0,
+                total_xp INTEGER DEFAULT 0,
+                last_practiced TEXT,
+                PRIMARY KEY(user_id, language)
+            )
+            """)
+            conn.execute("""
+            INSERT INTO user_stats (user_id, language, word_count, total_xp)
+            SELECT user_id, COALESCE(language, ''), COUNT(*), COALESCE(SUM(usage_count), 0)
+            FROM user_words GROUP BY user_id, COALESCE(language, '')
+            """)
+            print("✅ База даних оновлена: заповнено таблицю user_stats")
+        for trigger in USER_STATS_TRIGGERS:
+            conn.execute(trigger)
+        conn.execute("COMMIT")
+    except sqlite3.Error:
+        conn.execute("ROLLBACK")
+        raise
 
 
 # Функція для автоматичного додавання нових колонок у старі бази даних
-def migrate_db():
+def migrate_db(cursor):
     columns = [
         ("image_url", "TEXT"),
         ("association", "TEXT"),
@@ -109,79 +476,801 @@ def migrate_db():
     except sqlite3.OperationalError:
         pass
 
-    conn.commit()
-
-
-migrate_db()
-
-
-# МЕНЕДЖЕР API КЛЮЧІВ GEMINI
-class KeyManager:
-    def __init__(self, keys):
-        self.keys = keys
-        self.current_index = 0
-        self.client = self._init_client()
-
-    def _init_client(self):
-        if not self.keys or not self.keys[0]:
-            print("❌ Помилка: Список GEMINI_API_KEYS порожній або містить пусті рядки!")
+    # Колонки інтервального повторення (SM-2)
+    srs_columns = [
+        ("due_at", "TEXT"),
+        ("ease", "REAL DEFAULT 2.5"),
+        ("interval", "REAL DEFAULT 0"),
+        ("reps", "INTEGER DEFAULT 0")
+    ]
+    for col_name, col_type in srs_columns:
+        try:
+            cursor.execute(f"ALTER TABLE user_words ADD COLUMN {col_name} {col_type}")
+            print(f"✅ База даних оновлена: додано колонку {col_name}")
+        except sqlite3.OperationalError:
+            pass
+    # Старі слова стають "до повторення" одразу
+    cursor.execute("UPDATE user_words SET due_at=? WHERE due_at IS NULL", (datetime.now().isoformat(),))
+
+
+# АСИНХРОННЕ СХОВИЩЕ
+# Усі звернення до SQLite виконуються поза циклом подій:
+# записи - в одному окремому потоці (SQLite все одно допускає лише одного записувача),
+# читання - в невеликому пулі потоків, кожен зі своїм з'єднанням.
+class Database:
+    def __init__(self, path, readers=DB_READERS):
+        self.path = path
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+        self._local = threading.local()
+        self._write_conn = None
+
+    def _connect(self, readonly=False):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        if readonly:
+            conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    def _read_job(self, fn):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect(readonly=True)
+        return fn(conn)
+
+    def _write_job(self, fn):
+        # Викликається тільки з потоку-записувача
+        if self._write_conn is None:
+            self._write_conn = self._connect()
+        # with conn: COMMIT при успіху, ROLLBACK при помилці
+        with self._write_conn:
+            return fn(self._write_conn)
+
+    async def _timed(self, kind, executor, job, fn):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(executor, job, fn)
+        except sqlite3.Error:
+            DB_ERRORS.inc(kind)
+            raise
+        finally:
+            DB_LATENCY.observe(time.perf_counter() - started, kind)
+
+    async def read(self, fn):
+        return await self._timed("read", self._readers, self._read_job, fn)
+
+    async def transaction(self, fn):
+        # fn(conn) виконується в одній транзакції на з'єднанні записувача
+        return await self._timed("write", self._writer, self._write_job, fn)
+
+    async def execute(self, sql, params=()):
+        return await self.transaction(lambda conn: conn.execute(sql, params).rowcount)
+
+    async def executemany(self, sql, seq_of_params):
+        return await self.transaction(lambda conn: conn.executemany(sql, seq_of_params).rowcount)
+
+    async def fetchall(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def fetchone(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchone())
+
+    def close(self):
+        self._readers.shutdown(wait=True)
+        self._writer.shutdown(wait=True)
+        if self._write_conn is not None:
+            self._write_conn.close()
+            self._write_conn = None
+
+
+# ВІДКЛАДЕНИЙ ЗАПИС (write-behind)
+FLUSH_INTERVAL = 2.0  # секунди між скиданнями буфера
+FLUSH_THRESHOLD = 500  # скинути раніше, якщо накопичилось стільки записів
+
+
+# Накопичує час активності та прирости usage_count у пам'яті
+# і записує їх в БД однією транзакцією (замість commit на кожне повідомлення)
+class WriteBehindBuffer:
+    def __init__(self, database, interval=FLUSH_INTERVAL, threshold=FLUSH_THRESHOLD):
+        self.db = database
+        self.interval = interval
+        self.threshold = threshold
+        self._last_active = {}  # user_id -> ISO час
+        self._usage = {}  # (user_id, word) -> приріст
+        self._reviews = {}  # (user_id, word, language) -> (due_at, ease, interval, reps)
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self._closing = False
+
+        # Метрики
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.errors = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+    @property
+    def queue_depth(self):
+        return len(self._last_active) + len(self._usage) + len(self._reviews)
+
+    def touch(self, user_id):
+        self._last_active[user_id] = datetime.now().isoformat()
+        self._check_threshold()
+
+    def add_usage(self, user_id, word, delta=1):
+        key = (user_id, word)
+        self._usage[key] = self._usage.get(key, 0) + delta
+        self._check_threshold()
+
+    def schedule(self, user_id, word, language, due_at, ease, interval, reps):
+        self._reviews[(user_id, word, language)] = (due_at, ease, interval, reps)
+        self._check_threshold()
+
+    def _check_threshold(self):
+        if self.queue_depth >= self.threshold:
+            self._wakeup.set()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._last_active and not self._usage and not self._reviews:
+                return
+
+            last_active, self._last_active = self._last_active, {}
+            usage, self._usage = self._usage, {}
+            reviews, self._reviews = self._reviews, {}
+
+            def _apply(conn):
+                conn.executemany("UPDATE users SET last_active=? WHERE user_id=?",
+                                 [(ts, uid) for uid, ts in last_active.items()])
+                conn.executemany("UPDATE user_words SET usage_count = usage_count + ? WHERE user_id=? AND word=?",
+                                 [(delta, uid, word) for (uid, word), delta in usage.items()])
+                conn.executemany(
+                    "UPDATE user_words SET due_at=?, ease=?, interval=?, reps=? WHERE user_id=? AND word=? AND language=?",
+                    [(*sched, uid, word, lang) for (uid, word, lang), sched in reviews.items()])
+
+            started = time.perf_counter()
+            try:
+                await self.db.transaction(_apply)
+            except sqlite3.Error as e:
+                print(f"Database error in write-behind flush: {e}")
+                self.errors += 1
+                # Повертаємо дані в буфер, щоб не загубити їх (новіші значення мають пріоритет)
+                for uid, ts in last_active.items():
+                    self._last_active.setdefault(uid, ts)
+                for key, delta in usage.items():
+                    self._usage[key] = self._usage.get(key, 0) + delta
+                for key, sched in reviews.items():
+                    self._reviews.setdefault(key, sched)
+                return
+
+            latency = time.perf_counter() - started
+            self.flushes += 1
+            self.flushed_rows += len(last_active) + len(usage) + len(reviews)
+            self.last_flush_latency = latency
+            self.max_flush_latency = max(self.max_flush_latency, latency)
+
+            for uid in {uid for uid, _ in usage}:
+                invalidate_user_cache(uid)
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        # Зупиняємо фонову задачу і скидаємо все, що залишилось.
+        # Прапорець потрібен, бо wait_for може "проковтнути" скасування, якщо подія спрацювала одночасно з ним
+        self._closing = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth,
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+            "errors": self.errors,
+            "last_flush_latency_ms": round(self.last_flush_latency * 1000, 2),
+            "max_flush_latency_ms": round(self.max_flush_latency * 1000, 2),
+        }
+
+
+# СХОВИЩЕ СТАНІВ FSM
+FSM_FLUSH_INTERVAL = 1.0  # секунди між записами змінених станів у БД
+FSM_STATE_TTL = 7 * 24 * 60 * 60  # стан, що не змінювався тиждень, вважається застарілим
+FSM_CACHE_IDLE = 60 * 60  # неактивні записи прибираються з пам'яті через годину
+FSM_PRUNE_EVERY = 10 * 60  # як часто чистити пам'ять і застарілі рядки
+
+
+def fsm_key(key: StorageKey):
+    return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or 0}:{key.destiny}"
+
+
+# Сховище станів aiogram у words.db: читання йдуть з кешу в пам'яті,
+# зміни одразу потрапляють у кеш, а в БД записуються пачками раз на FSM_FLUSH_INTERVAL.
+# Кеш вважається джерелом істини і з БД не звіряється, тому стан користувача коректний лише тоді,
+# коли його оновлення обробляє один процес. Так працює BOT_WORKERS (приймач закріплює користувача
+# за обробником); кілька незалежних реплік за балансувальником без такого закріплення бачитимуть
+# застарілий стан до FSM_CACHE_IDLE. БД дає лише збереження станів між перезапусками
+class SQLiteStorage(BaseStorage):
+    def __init__(self, database, ttl=FSM_STATE_TTL, interval=FSM_FLUSH_INTERVAL, idle=FSM_CACHE_IDLE):
+        self.db = database
+        self.ttl = ttl
+        self.interval = interval
+        self.idle = idle
+        self._cache = {}  # ключ -> [state, data, updated_at]
+        self._dirty = set()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self._closing = False
+        self._last_prune = time.time()
+
+        # Метрики
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.errors = 0
+
+    async def _entry(self, key):
+        k = fsm_key(key)
+        now = time.time()
+        entry = self._cache.get(k)
+        if entry is None:
+            self.misses += 1
+            try:
+                row = await self.db.fetchone("SELECT state, data, updated_at FROM fsm_states WHERE key=?", (k,))
+            except sqlite3.Error as e:
+                print(f"Database error in fsm load: {e}")
+                row = None
+            if row:
+                entry = [row[0], json.loads(row[1]) if row[1] else {}, row[2]]
+            else:
+                entry = [None, {}, now]
+            # Поки ми читали, стан могли вже змінити - значення в кеші новіше за БД
+            entry = self._cache.setdefault(k, entry)
+        else:
+            self.hits += 1
+
+        if entry[2] < now - self.ttl:
+            self.expired += 1
+            entry[0], entry[1], entry[2] = None, {}, now
+            self._dirty.add(k)
+        return k, entry
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k, entry = await self._entry(key)
+        entry[0] = state.state if isinstance(state, State) else state
+        entry[2] = time.time()
+        self._dirty.add(k)
+
+    async def get_state(self, key: StorageKey):
+        _, entry = await self._entry(key)
+        return entry[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        k, entry = await self._entry(key)
+        entry[1] = data.copy()
+        entry[2] = time.time()
+        self._dirty.add(k)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, entry = await self._entry(key)
+        return entry[1].copy()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            keys, self._dirty = self._dirty, set()
+
+            upserts, deletes = [], []
+            for k in keys:
+                entry = self._cache.get(k)
+                if entry is None:
+                    continue
+                state, data, updated_at = entry
+                if state is None and not data:
+                    deletes.append((k,))
+                else:
+                    upserts.append((k, state, json.dumps(data, ensure_ascii=False), updated_at))
+
+            def _apply(conn):
+                conn.executemany("INSERT OR REPLACE INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?)",
+                                 upserts)
+                conn.executemany("DELETE FROM fsm_states WHERE key=?", deletes)
+
+            try:
+                await self.db.transaction(_apply)
+            except sqlite3.Error as e:
+                print(f"Database error in fsm flush: {e}")
+                self.errors += 1
+                self._dirty |= keys
+                return
+            self.flushes += 1
+            self.flushed_rows += len(upserts) + len(deletes)
+
+    async def prune(self):
+        # Прибираємо з пам'яті записи, які давно не змінювались (вони вже в БД), і застарілі рядки з БД
+        now = time.time()
+        for k in [k for k, e in self._cache.items() if e[2] < now - self.idle and k not in self._dirty]:
+            del self._cache[k]
+        try:
+            await self.db.execute("DELETE FROM fsm_states WHERE updated_at < ?", (now - self.ttl,))
+        except sqlite3.Error as e:
+            print(f"Database error in fsm prune: {e}")
+        self._last_prune = now
+
+    async def _run(self):
+        while not self._closing:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+            if time.time() - self._last_prune >= FSM_PRUNE_EVERY:
+                await self.prune()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        # Викликається і диспетчером при зупинці, і з main() - повторний виклик лише скидає залишок
+        self._closing = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def stats(self):
+        return {
+            "cached": len(self._cache),
+            "dirty": len(self._dirty),
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+            "errors": self.errors,
+        }
+
+
+init_db()
+db = Database(DB_PATH)
+write_buffer = WriteBehindBuffer(db)
+fsm_storage = SQLiteStorage(db)
+
+
+# КОНТРОЛЬ ДОПУСКУ ДО ЗОВНІШНІХ СЕРВІСІВ
+# Для кожного сервісу: (одночасних запитів, місць у черзі, скільки секунд максимум чекати в черзі).
+# Ліміти загальні на весь бот. Обмежувачі живуть у пам'яті процесу, тому з BOT_WORKERS > 1 кожен
+# процес-обробник отримує свою частку (1/BOT_WORKERS) цих лімітів і GEMINI_RPM
+UPSTREAM_LIMITS = {
+    "gemini": (8, 40, 15.0),
+    "pixabay": (10, 100, 5.0),
+    "translator": (4, 100, 10.0),
+}
+UPSTREAM_SHARE = max(BOT_WORKERS, 1)
+
+
+# Сервіс перевантажений: черга повна або час очікування вичерпано.
+# Текст одразу придатний для відповіді користувачу
+class UpstreamBusy(Exception):
+    def __init__(self, name):
+        super().__init__(f"⏳ Сервіс зараз перевантажений ({name}). Спробуйте ще раз за хвилину.")
+        self.name = name
+
+
+# Обмежує кількість одночасних звернень до сервісу; решта чекає в обмеженій черзі
+class AdmissionGate:
+    registry = []
+
+    def __init__(self, name):
+        self.name = name
+        limit, queue_size, self.deadline = UPSTREAM_LIMITS[name]
+        self.limit = max(1, limit // UPSTREAM_SHARE)
+        self.queue_size = max(1, queue_size // UPSTREAM_SHARE)
+        self._semaphore = asyncio.Semaphore(self.limit)
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.waits = deque(maxlen=1000)  # час очікування в черзі (с) для останніх запитів
+        self.max_wait = 0.0
+        AdmissionGate.registry.append(self)
+
+    async def run(self, fn, *args, **kwargs):
+        if self.in_flight + self.waiting >= self.limit + self.queue_size:
+            self.rejected += 1
+            UPSTREAM_REJECTED.inc(self.name, "queue_full")
+            raise UpstreamBusy(self.name)
+
+        started = time.perf_counter()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.deadline)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            UPSTREAM_REJECTED.inc(self.name, "deadline")
+            raise UpstreamBusy(self.name)
+        finally:
+            self.waiting -= 1
+
+        wait = time.perf_counter() - started
+        self.waits.append(wait)
+        self.max_wait = max(self.max_wait, wait)
+        UPSTREAM_QUEUE_WAIT.observe(wait, self.name)
+        self.admitted += 1
+        self.in_flight += 1
+        started = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        except Exception:
+            UPSTREAM_ERRORS.inc(self.name)
+            raise
+        finally:
+            UPSTREAM_LATENCY.observe(time.perf_counter() - started, self.name)
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    def stats(self):
+        waits = sorted(self.waits)
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "wait_p50_ms": round(waits[len(waits) // 2] * 1000, 2) if waits else 0.0,
+            "wait_p95_ms": round(waits[int(len(waits) * 0.95)] * 1000, 2) if waits else 0.0,
+            "max_wait_ms": round(self.max_wait * 1000, 2),
+        }
+
+
+# ПУЛ API КЛЮЧІВ GEMINI
+GEMINI_MODEL = "gemini-2.5-flash"
+GEMINI_COOLDOWN = 60  # секунд відпочинку для ключа після 429
+GEMINI_MAX_WAIT = 30  # скільки максимум чекати на вільний ключ
+
+
+def is_quota_error(e):
+    error_msg = str(e).lower()
+    return "429" in error_msg or "quota" in error_msg or "exhausted" in error_msg
+
+
+# Відро токенів: не більше rate запитів на хвилину з одного ключа
+class TokenBucket:
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self):
+        self._refill()
+        return self.tokens
+
+    # Бере токен наперед: повертає час очікування (0 - одразу) або None, якщо чекати довелося б довше max_delay
+    def take(self, max_delay=0.0):
+        self._refill()
+        if self.tokens - 1 < -max_delay * self.rate:
             return None
-        print(f"🔄 Gemini: Використовую ключ №{self.current_index + 1}")
-        return genai.Client(api_key=self.keys[self.current_index])
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def try_take(self):
+        return self.take() is not None
+
+    def is_full(self):
+        return self.available() >= self.capacity
+
+    def wait_time(self):
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class GeminiKey:
+    def __init__(self, index, api_key, rpm):
+        self.index = index
+        self.client = genai.Client(api_key=api_key)
+        # Частка ліміту процесу може бути меншою за 1 запит на хвилину - відро все одно вміщує хоча б один
+        self.bucket = TokenBucket(rpm, max(rpm, 1))
+        self.cooldown_until = 0.0
+        self.in_flight = 0
+        self.requests = 0
+        self.quota_errors = 0
+
+
+# Асинхронний пул ключів: кожен ключ має свій клієнт (client.aio), ліміт запитів та "охолодження" після 429.
+# Запит отримує найменш завантажений ключ, тож паралельні запити розподіляються між усіма ключами.
+# Вибір ключа не містить await, тому він атомарний в межах циклу подій і не потребує блокувань.
+class GeminiKeyPool:
+    def __init__(self, keys, rpm, cooldown=GEMINI_COOLDOWN, max_wait=GEMINI_MAX_WAIT):
+        self.keys = [GeminiKey(i, k, rpm) for i, k in enumerate(keys) if k]
+        self.cooldown = cooldown
+        self.max_wait = max_wait
+        self.rotations = 0  # скільки разів ключ відправлено на "охолодження"
+        self.gate = AdmissionGate("gemini")
+        if not self.keys:
+            print("❌ Помилка: Список GEMINI_API_KEYS порожній або містить пусті рядки!")
 
-    def get_client(self):
-        return self.client
+    def _pick(self):
+        now = time.monotonic()
+        ready = [k for k in self.keys if k.cooldown_until <= now]
+        for key in sorted(ready, key=lambda k: (k.in_flight, -k.bucket.available())):
+            if key.bucket.try_take():
+                key.in_flight += 1
+                key.requests += 1
+                return key, 0.0
+        # Вільних ключів немає - рахуємо, коли з'явиться найближчий
+        wait = min(max(k.cooldown_until - now, k.bucket.wait_time()) for k in self.keys)
+        return None, wait
+
+    async def acquire(self):
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            key, wait = self._pick()
+            if key:
+                return key
+            if time.monotonic() + wait > deadline:
+                raise Exception("❌ Всі API ключі вичерпано.")
+            await asyncio.sleep(wait)
+
+    def release(self, key):
+        key.in_flight -= 1
+
+    # Чи можна фоновій задачі звернутися до Gemini: ніхто не чекає в черзі, а після запиту
+    # у готових ключах лишиться щонайменше частка reserve від їхньої сумарної ємності
+    def has_spare(self, reserve):
+        if not self.keys or self.gate.waiting:
+            return False
+        now = time.monotonic()
+        spare = sum(k.bucket.available() for k in self.keys if k.cooldown_until <= now)
+        return spare - 1 >= reserve * sum(k.bucket.capacity for k in self.keys)
+
+    def mark_exhausted(self, key):
+        key.cooldown_until = time.monotonic() + self.cooldown
+        key.quota_errors += 1
+        self.rotations += 1
+        print(f"⚠️ Gemini: ключ №{key.index + 1} вичерпано, відпочиває {self.cooldown} с")
+
+    async def generate(self, contents, config=None, model=GEMINI_MODEL):
+        if not self.keys:
+            raise Exception("API ключі не налаштовані")
+        return await self.gate.run(self._generate, contents, config, model)
+
+    async def _generate(self, contents, config, model):
+        attempts = 0
+        max_attempts = len(self.keys) + 1  # +1 спроба
+        while attempts < max_attempts:
+            key = await self.acquire()
+            try:
+                return await key.client.aio.models.generate_content(
+                    model=model,
+                    config=config,
+                    contents=contents,
+                )
+            except Exception as e:
+                if not is_quota_error(e):
+                    raise e
+                print(f"⚠️ Gemini Error ({e}). Пробую наступний ключ...")
+                self.mark_exhausted(key)
+                attempts += 1
+            finally:
+                self.release(key)
+        raise Exception("❌ Всі API ключі вичерпано.")
 
-    def rotate_key(self):
-        self.current_index = (self.current_index + 1) % len(self.keys)
-        print(f"⚠️ Gemini: Перемикаю на ключ №{self.current_index + 1}")
-        self.client = self._init_client()
+    def stats(self):
+        now = time.monotonic()
+        return {
+            "rotations": self.rotations,
+            "keys": [{
+                "key": k.index + 1,
+                "requests": k.requests,
+                "in_flight": k.in_flight,
+                "quota_errors": k.quota_errors,
+                "cooldown_s": round(max(k.cooldown_until - now, 0), 1),
+                "tokens": round(k.bucket.available(), 2),
+            } for k in self.keys],
+        }
 
 
-key_manager = KeyManager(GEMINI_API_KEYS)
+key_pool = GeminiKeyPool(GEMINI_API_KEYS, GEMINI_RPM / UPSTREAM_SHARE)
 
 
 # Функція для безпечного виконання запитів з ротацією ключів
-def generate_content_safe(contents, config=None, model="gemini-2.5-flash"):
-    attempts = 0
-    max_attempts = len(GEMINI_API_KEYS) + 1  # +1 спроба
-
-    while attempts < max_attempts:
-        try:
-            client = key_manager.get_client()
-            if not client: raise Exception("API ключі не налаштовані")
-
-            response = client.models.generate_content(
-                model=model,
-                config=config,
-                contents=contents,
-            )
-            return response
-        except Exception as e:
-            error_msg = str(e).lower()
-            if "429" in error_msg or "quota" in error_msg or "exhausted" in error_msg:
-                print(f"⚠️ Gemini Error ({e}). Пробую наступний ключ...")
-                key_manager.rotate_key()
-                attempts += 1
-            else:
-                raise e
-    raise Exception("❌ Всі API ключі вичерпано.")
+async def generate_content_safe(contents, config=None, model=GEMINI_MODEL):
+    return await key_pool.generate(contents, config=config, model=model)
 
 # Веб-сервер, щоб хостинг бачив відкритий порт
 async def health_check(request):
     return web.Response(text="I am alive! Bot is running.")
 
-async def start_web_server():
+# Стан внутрішніх компонентів бота (метрики у форматі JSON)
+async def status_handler(request):
+    return web.json_response({
+        "write_buffer": write_buffer.stats(),
+        "fsm": fsm_storage.stats(),
+        "throttling": throttling.stats(),
+        "pixabay": image_search.stats(),
+        "word_info_cache": word_info_cache.stats(),
+        "gemini": key_pool.stats(),
+        "translator": translation_service.stats(),
+        "single_flight": {f.name: f.stats() for f in SingleFlight.registry},
+        "upstreams": {g.name: g.stats() for g in AdmissionGate.registry},
+        "word_of_day_pool": wod_pool.stats(),
+        "deck": deck_cache.stats(),
+        "game_results": game_results.stats(),
+        "updates": request.app["updates"].stats() if "updates" in request.app else None,
+    })
+
+# Метрики у форматі Prometheus
+async def metrics_handler(request):
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+async def start_web_server(webhook=None, updates=None, port=None):
     app = web.Application()
     app.router.add_get('/', health_check)
+    app.router.add_get('/status', status_handler)
+    app.router.add_get('/metrics', metrics_handler)
+    app.router.add_get('/deck', deck_handler)
+    app.router.add_options('/deck', cors_preflight)
+    app.router.add_post('/game/result', game_result_handler)
+    app.router.add_options('/game/result', cors_preflight)
+    if webhook is not None:
+        webhook.register(app, path=WEBHOOK_PATH)
+    if updates is not None:
+        app["updates"] = updates
     runner = web.AppRunner(app)
     await runner.setup()
     
-    port = int(os.environ.get("PORT", 8080)) 
+    if port is None:
+        port = int(os.environ.get("PORT", 8080))
     site = web.TCPSite(runner, '0.0.0.0', port)
     await site.start()
     print(f"🌍 Веб-сервер запущено на порту {port}")
 
+# ЧЕРГИ ОНОВЛЕНЬ
+# Id користувача з "сирого" оновлення: message.from, callback_query.from, poll_answer.user, або чат
+def update_user_id(update):
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        user = value.get("from") or value.get("user")
+        if isinstance(user, dict) and "id" in user:
+            return user["id"]
+        chat = value.get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return chat["id"]
+    return update.get("update_id", 0)
+
+
+# Кілька обмежених черг оновлень усередині процесу. Користувач завжди потрапляє в ту саму чергу,
+# тому його повідомлення обробляються по порядку, а різні користувачі - паралельно.
+class UpdateShards:
+    def __init__(self, dispatcher, bot, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.queues = [asyncio.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._tasks = []
+        self._closed = False
+
+        # Метрики
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.errors = 0
+        self.max_queue_wait = 0.0
+
+    def _queue(self, update):
+        return self.queues[hash(update_user_id(update)) % len(self.queues)]
+
+    def submit(self, update):
+        # Без очікування: False, якщо черга переповнена
+        if self._closed:
+            return False
+        try:
+            self._queue(update).put_nowait((time.perf_counter(), update))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        self.accepted += 1
+        return True
+
+    async def put(self, update):
+        # З очікуванням вільного місця (зворотний тиск на джерело оновлень)
+        await self._queue(update).put((time.perf_counter(), update))
+        self.accepted += 1
+
+    async def _worker(self, queue):
+        while True:
+            queued_at, update = await queue.get()
+            self.max_queue_wait = max(self.max_queue_wait, time.perf_counter() - queued_at)
+            try:
+                await self.dispatcher.feed_raw_update(self.bot, update)
+                self.processed += 1
+            except Exception as e:
+                self.errors += 1
+                print(f"Error while processing update: {e}")
+            finally:
+                queue.task_done()
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker(q)) for q in self.queues]
+
+    async def close(self, timeout=10):
+        # Нові оновлення більше не приймаємо, чекаємо на обробку вже прийнятих
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self.queues)), timeout)
+        except asyncio.TimeoutError:
+            print("⚠️ Не всі оновлення з черги встигли обробитись")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self):
+        return {
+            "workers": len(self.queues),
+            "queue_depth": sum(q.qsize() for q in self.queues),
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "processed": self.processed,
+            "errors": self.errors,
+            "max_queue_wait_ms": round(self.max_queue_wait * 1000, 2),
+        }
+
+
+# Обробник вебхука: перевіряє секрет (це робить SimpleRequestHandler), одразу відповідає Telegram
+# і передає оновлення в черги (UpdateShards або ProcessRouter). Якщо черга повна - відповідаємо 503,
+# і Telegram надішле оновлення повторно пізніше.
+class QueuedRequestHandler(SimpleRequestHandler):
+    def __init__(self, dispatcher, bot, secret_token, sink):
+        super().__init__(dispatcher, bot, handle_in_background=True, secret_token=secret_token)
+        self.sink = sink
+
+    async def _handle_request_background(self, bot, request):
+        try:
+            update = await request.json(loads=bot.session.json_loads)
+        except ValueError:
+            return web.Response(status=400)
+        if not self.sink.submit(update):
+            return web.Response(status=503)
+        return web.json_response({})
+
+
 # Функція, яка робить щось кожні 40 секунд
 async def keep_alive_task():
     while True:
@@ -192,6 +1281,110 @@ async def keep_alive_task():
             print(f"Error in keep_alive: {e}")
 
 
+# ОБ'ЄДНАННЯ ОДНАКОВИХ ЗАПИТІВ (single-flight)
+# Поки запит з певним ключем виконується, інші виклики з тим самим ключем
+# не йдуть до API, а чекають на результат першого.
+class SingleFlight:
+    registry = []
+
+    def __init__(self, name):
+        self.name = name
+        self._inflight = {}
+        self.calls = 0
+        self.coalesced = 0
+        SingleFlight.registry.append(self)
+
+    async def do(self, key, fn, *args, **kwargs):
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.calls += 1
+            task = asyncio.ensure_future(fn(*args, **kwargs))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._inflight.pop(key) if self._inflight.get(key) is t else None)
+        # shield: скасування одного з очікувачів не скасовує спільний запит
+        return await asyncio.shield(task)
+
+    # Декоратор: @flight.coalesce(lambda *args: ключ)
+    def coalesce(self, key_fn):
+        def decorator(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                return await self.do(key_fn(*args, **kwargs), fn, *args, **kwargs)
+            return wrapper
+        return decorator
+
+    def stats(self):
+        return {"calls": self.calls, "coalesced": self.coalesced, "in_flight": len(self._inflight)}
+
+
+# ПОШУК КАРТИНОК (Pixabay)
+PIXABAY_URL = "https://pixabay.com/api/"
+PIXABAY_CACHE_SIZE = 2048
+PIXABAY_CACHE_TTL = 6 * 60 * 60  # 6 годин
+
+
+# Одна довгоживуча сесія з пулом keep-alive з'єднань та LRU+TTL кеш відповідей.
+# Кеш зберігає весь список hits, тож "🔄 Інше фото" вибирає з нього без нового HTTP-запиту.
+class ImageSearch:
+    def __init__(self, api_key, cache_size=PIXABAY_CACHE_SIZE, cache_ttl=PIXABAY_CACHE_TTL):
+        self.api_key = api_key
+        self.session = None
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self.hits = 0
+        self.misses = 0
+        self.flight = SingleFlight("pixabay")
+        self.gate = AdmissionGate("pixabay")
+
+    async def start(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=20, limit_per_host=10, keepalive_timeout=60, ttl_dns_cache=300)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=10))
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def search(self, query, per_page):
+        key = (query, per_page)
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+        self.misses += 1
+        return await self.flight.do(key, self.gate.run, self._fetch, query, per_page)
+
+    async def _fetch(self, query, per_page):
+        # На випадок виклику до main() (наприклад, зі скриптів)
+        await self.start()
+        params = {
+            "key": self.api_key, "q": query, "image_type": "photo",
+            "orientation": "horizontal", "safesearch": "true", "per_page": per_page,
+        }
+        async with self.session.get(PIXABAY_URL, params=params) as resp:
+            if resp.status != 200:
+                return []
+            data = await resp.json()
+
+        hits = data.get('hits') or []
+        self.cache[(query, per_page)] = hits
+        return hits
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "cache_hits": self.hits,
+            "cache_misses": self.misses,
+            "hit_ratio": round(self.hits / total, 3) if total else 0.0,
+            "cache_size": len(self.cache),
+        }
+
+
+image_search = ImageSearch(PIXABAY_API_KEY)
+
+
 # Функція пошуку картинки на Pixabay
 async def get_image_url(query, use_random=False):
     if not query or not PIXABAY_API_KEY:
@@ -200,36 +1393,134 @@ async def get_image_url(query, use_random=False):
         # Шукаємо більше картинок (20), якщо потрібна випадкова
         per_page = 20 if use_random else 3
 
-        encoded_query = urllib.parse.quote(query)
-        url = f"https://pixabay.com/api/?key={PIXABAY_API_KEY}&q={encoded_query}&image_type=photo&orientation=horizontal&safesearch=true&per_page={per_page}"
-
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    if data['hits']:
-                        if use_random:
-                            return random.choice(data['hits'])['webformatURL']
-                        else:
-                            return data['hits'][0]['webformatURL']
+        hits = await image_search.search(query, per_page)
+        if hits:
+            if use_random:
+                return random.choice(hits)['webformatURL']
+            else:
+                return hits[0]['webformatURL']
     except Exception as e:
         print(f"Pixabay Error: {e}")
     return None
 
 
+# КЕШ ЗБАГАЧЕННЯ СЛІВ (транскрипція, асоціація, промпт для фото)
+WORD_INFO_PROMPT = (
+    "Analyze the word '{word}' (language: {lang}, translation: '{translation}'). "
+    "Return ONLY a string in this format: "
+    "TRANSCRIPTION|ASSOCIATION|VISUAL_SEARCH_PROMPT\n"
+    "1. Transcription: Ukrainian letters inside brackets (e.g. [хелоу]).\n"
+    "2. Association: A short funny mnemonic sentence in Ukrainian to remember the word.\n"
+    "3. Visual Search Prompt: A short 3-5 word English phrase describing a photograph depicting the association, strictly without any text, signs, or words in the image. Focus on objects, nature, or actions.\n"
+    "Example output for 'freedom': [фрідом]|Уяви птаха, який вилетів з клітки на волю.|bird flying out of cage in sky"
+)
+# Версія кешу прив'язана до тексту промпту: змінили промпт - старі записи більше не використовуються
+WORD_INFO_PROMPT_VERSION = hashlib.sha1(WORD_INFO_PROMPT.encode()).hexdigest()[:12]
+WORD_INFO_TTL_DAYS = 90
+WORD_INFO_MEMORY_SIZE = 5000
+
+
+def word_info_key(word, translation, lang):
+    return word.strip().lower(), lang, (translation or "").strip().lower()
+
+
+# Спільний для всіх користувачів кеш відповідей ШІ: LRU у пам'яті + таблиця word_info_cache у БД
+class WordInfoCache:
+    def __init__(self, database, memory_size=WORD_INFO_MEMORY_SIZE, ttl_days=WORD_INFO_TTL_DAYS):
+        self.db = database
+        self.memory = LRUCache(maxsize=memory_size)
+        self.ttl_days = ttl_days
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    def _cutoff(self):
+        return (datetime.now() - timedelta(days=self.ttl_days)).isoformat()
+
+    async def get(self, key):
+        entry = self.memory.get(key)
+        if entry is not None:
+            created_at, info = entry
+            if created_at >= self._cutoff():
+                self.memory_hits += 1
+                return info
+            del self.memory[key]
+
+        try:
+            row = await self.db.fetchone(
+                "SELECT transcription, association, visual_prompt, created_at FROM word_info_cache "
+                "WHERE word_norm=? AND language=? AND translation_norm=? AND prompt_version=? AND created_at>=?",
+                (*key, WORD_INFO_PROMPT_VERSION, self._cutoff()))
+        except sqlite3.Error as e:
+            print(f"Database error in word info cache: {e}")
+            row = None
+
+        if row:
+            self.db_hits += 1
+            info = (row[0], row[1], row[2])
+            self.memory[key] = (row[3], info)
+            return info
+
+        self.misses += 1
+        return None
+
+    async def put(self, key, info):
+        created_at = datetime.now().isoformat()
+        self.memory[key] = (created_at, info)
+        try:
+            await self.db.execute(
+                "INSERT OR REPLACE INTO word_info_cache (word_norm, language, translation_norm, prompt_version, "
+                "transcription, association, visual_prompt, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (*key, WORD_INFO_PROMPT_VERSION, *info, created_at))
+        except sqlite3.Error as e:
+            print(f"Database error in word info cache: {e}")
+
+    async def warm_up(self, limit):
+        # Видаляємо застарілі записи та (за бажанням) підвантажуємо найсвіжіші в пам'ять
+        try:
+            await self.db.execute("DELETE FROM word_info_cache WHERE prompt_version!=? OR created_at<?",
+                                  (WORD_INFO_PROMPT_VERSION, self._cutoff()))
+            if limit <= 0:
+                return
+            rows = await self.db.fetchall(
+                "SELECT word_norm, language, translation_norm, transcription, association, visual_prompt, created_at "
+                "FROM word_info_cache ORDER BY created_at DESC LIMIT ?", (min(limit, self.memory.maxsize),))
+        except sqlite3.Error as e:
+            print(f"Database error in word info cache warm-up: {e}")
+            return
+
+        for r in reversed(rows):
+            self.memory[(r[0], r[1], r[2])] = (r[6], (r[3], r[4], r[5]))
+        print(f"🧠 Кеш ШІ: завантажено {len(rows)} записів")
+
+    def stats(self):
+        total = self.memory_hits + self.db_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "hit_ratio": round((self.memory_hits + self.db_hits) / total, 3) if total else 0.0,
+            "memory_size": len(self.memory),
+        }
+
+
+word_info_cache = WordInfoCache(db)
+
+
+word_info_flight = SingleFlight("word_info")
+
+
 # Функція отримання транскрипції та асоціації від ШІ
+@word_info_flight.coalesce(word_info_key)
 async def get_full_word_info(word, translation, lang):
-    prompt = (
-        f"Analyze the word '{word}' (language: {lang}, translation: '{translation}'). "
-        f"Return ONLY a string in this format: "
-        f"TRANSCRIPTION|ASSOCIATION|VISUAL_SEARCH_PROMPT\n"
-        f"1. Transcription: Ukrainian letters inside brackets (e.g. [хелоу]).\n"
-        f"2. Association: A short funny mnemonic sentence in Ukrainian to remember the word.\n"
-        f"3. Visual Search Prompt: A short 3-5 word English phrase describing a photograph depicting the association, strictly without any text, signs, or words in the image. Focus on objects, nature, or actions.\n"
-        f"Example output for 'freedom': [фрідом]|Уяви птаха, який вилетів з клітки на волю.|bird flying out of cage in sky"
-    )
+    key = word_info_key(word, translation, lang)
+    cached = await word_info_cache.get(key)
+    if cached:
+        return cached
+
+    prompt = WORD_INFO_PROMPT.format(word=word, lang=lang, translation=translation)
     try:
-        response = await asyncio.to_thread(generate_content_safe, contents=prompt)
+        response = await generate_content_safe(contents=prompt)
         text = response.text.strip().replace("*", "")
         parts = text.split("|")
 
@@ -237,6 +1528,8 @@ async def get_full_word_info(word, translation, lang):
             transc = parts[0].strip()
             assoc = parts[1].strip()
             visual_prompt = parts[2].strip()
+            # Кешуємо лише повністю розпізнані відповіді
+            await word_info_cache.put(key, (transc, assoc, visual_prompt))
             return transc, assoc, visual_prompt
         elif len(parts) == 2:
             # Fallback для старого формату
@@ -247,7 +1540,158 @@ async def get_full_word_info(word, translation, lang):
         return "[?]", None, word
 
 
+# СЕРВІС ПЕРЕКЛАДУ
+TRANSLATOR_THREADS = 4
+TRANSLATION_MEMORY_SIZE = 5000
+TRANSLATION_CACHE_ROWS = 50000  # максимум записів у таблиці translation_cache
+TRANSLATION_PRUNE_EVERY = 1000  # як часто (у нових записах) підрізати таблицю
+
+
+# GoogleTranslator робить блокуючі HTTP-запити, тому переклад виконується в окремому пулі потоків
+# (у кожного потоку свій екземпляр перекладача). Результати кешуються в пам'яті та в БД,
+# а однакові одночасні запити чекають на один і той самий виклик.
+class TranslationService:
+    def __init__(self, database, target="uk", threads=TRANSLATOR_THREADS,
+                 memory_size=TRANSLATION_MEMORY_SIZE, max_rows=TRANSLATION_CACHE_ROWS):
+        self.db = database
+        self.target = target
+        self.max_rows = max_rows
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="translator")
+        self._local = threading.local()
+        self.memory = LRUCache(maxsize=memory_size)
+        self.flight = SingleFlight("translator")
+        self.gate = AdmissionGate("translator")
+        self._inserted = 0
+
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    def _translator(self):
+        translator = getattr(self._local, "translator", None)
+        if translator is None:
+            translator = self._local.translator = GoogleTranslator(source='auto', target=self.target)
+        return translator
+
+    def _translate_job(self, text):
+        return self._translator().translate(text)
+
+    def _translate_batch_job(self, texts):
+        return self._translator().translate_batch(texts)
+
+    async def _run(self, fn, *args):
+        # Через gate, щоб черга до потоків перекладача не росла без обмежень
+        loop = asyncio.get_running_loop()
+        return await self.gate.run(loop.run_in_executor, self.executor, fn, *args)
+
+    async def _store(self, rows):
+        # rows: [(word_norm, language, translation)]
+        now = datetime.now().isoformat()
+        try:
+            await self.db.executemany(
+                "INSERT OR REPLACE INTO translation_cache (word_norm, language, translation, created_at) VALUES (?, ?, ?, ?)",
+                [(*r, now) for r in rows])
+            self._inserted += len(rows)
+            if self._inserted >= TRANSLATION_PRUNE_EVERY:
+                self._inserted = 0
+                await self.prune()
+        except sqlite3.Error as e:
+            print(f"Database error in translation cache: {e}")
+
+    async def prune(self):
+        # Залишаємо лише max_rows найновіших записів
+        await self.db.execute(
+            "DELETE FROM translation_cache WHERE created_at < "
+            "(SELECT created_at FROM translation_cache ORDER BY created_at DESC LIMIT 1 OFFSET ?)",
+            (self.max_rows,))
+
+    async def _lookup(self, key, word):
+        try:
+            row = await self.db.fetchone(
+                "SELECT translation FROM translation_cache WHERE word_norm=? AND language=?", key)
+        except sqlite3.Error as e:
+            print(f"Database error in translation cache: {e}")
+            row = None
+        if row:
+            self.db_hits += 1
+            self.memory[key] = row[0]
+            return row[0]
+
+        self.misses += 1
+        translation = await self._run(self._translate_job, word)
+        if translation:
+            self.memory[key] = translation
+            await self._store([(*key, translation)])
+        return translation
+
+    async def translate(self, word, language):
+        key = (word.strip().lower(), language)
+        if key in self.memory:
+            self.memory_hits += 1
+            return self.memory[key]
+
+        return await self.flight.do(key, self._lookup, key, word)
+
+    async def translate_many(self, words, language):
+        # Пакетний переклад: кеш перевіряється одним запитом, а все відсутнє перекладається за один виклик
+        keys = [(w.strip().lower(), language) for w in words]
+        result = {k: self.memory[k] for k in keys if k in self.memory}
+        self.memory_hits += len(result)
+
+        missing = list(dict.fromkeys(k for k in keys if k not in result))
+        for i in range(0, len(missing), SQL_VARS_CHUNK):
+            chunk = [k[0] for k in missing[i:i + SQL_VARS_CHUNK]]
+            try:
+                rows = await self.db.fetchall(
+                    f"SELECT word_norm, translation FROM translation_cache WHERE language=? "
+                    f"AND word_norm IN ({','.join('?' * len(chunk))})", (language, *chunk))
+            except sqlite3.Error as e:
+                print(f"Database error in translation cache: {e}")
+                rows = []
+            for word_norm, translation in rows:
+                result[(word_norm, language)] = translation
+                self.memory[(word_norm, language)] = translation
+                self.db_hits += 1
+
+        originals = {}
+        for w, k in zip(words, keys):
+            if k not in result:
+                originals.setdefault(k, w)
+        if originals:
+            self.misses += len(originals)
+            translated = await self._run(self._translate_batch_job, list(originals.values()))
+            rows = []
+            for k, translation in zip(originals.keys(), translated):
+                if translation:
+                    result[k] = translation
+                    self.memory[k] = translation
+                    rows.append((*k, translation))
+            if rows:
+                await self._store(rows)
+
+        return [result.get(k) for k in keys]
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    def stats(self):
+        total = self.memory_hits + self.db_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "hit_ratio": round((self.memory_hits + self.db_hits) / total, 3) if total else 0.0,
+        }
+
+
+translation_service = TranslationService(db)
+
+
+ai_explanation_flight = SingleFlight("ai_explanation")
+
+
 # Функція для отримання пояснення слова від ШІ (оновлена)
+@ai_explanation_flight.coalesce(lambda content, language_of_word: (content.strip().lower(), language_of_word))
 async def get_ai_explanation_text(content, language_of_word):
     print(f"GenAI: Обробка запиту '{content}'...")
 
@@ -265,36 +1709,41 @@ async def get_ai_explanation_text(content, language_of_word):
         system_instruction=system_prompt
     )
 
-    response = await asyncio.to_thread(generate_content_safe, contents=content, config=config)
+    response = await generate_content_safe(contents=content, config=config)
     return response.text.replace("*", "")
 
 
 # ФУНКЦІЇ БАЗИ ДАНИХ
 
-def add_word_to_db(user_id, word, translation, language, image_url=None, association=None, transcription=None):
-    try:
+async def add_word_to_db(user_id, word, translation, language, image_url=None, association=None, transcription=None):
+    def _add(conn):
         # Якщо слово вже є, оновлюємо його дані (наприклад, нову картинку після регенерації)
-        cursor.execute("SELECT 1 FROM user_words WHERE user_id=? AND word=? AND language=?", (user_id, word, language))
-        if cursor.fetchone():
+        exists = conn.execute("SELECT 1 FROM user_words WHERE user_id=? AND word=? AND language=?",
+                              (user_id, word, language)).fetchone()
+        if exists:
             if image_url:
-                cursor.execute(
+                conn.execute(
                     "UPDATE user_words SET image_url=?, association=?, transcription=? WHERE user_id=? AND word=? AND language=?",
                     (image_url, association, transcription, user_id, word, language))
-                conn.commit()
             return False
 
-        cursor.execute(
-            "INSERT INTO user_words (user_id, word, translation, language, usage_count, image_url, association, transcription) VALUES (?, ?, ?, ?, 0, ?, ?, ?)",
-            (user_id, word, translation, language, image_url, association, transcription)
+        conn.execute(
+            "INSERT INTO user_words (user_id, word, translation, language, usage_count, image_url, association, transcription, due_at) VALUES (?, ?, ?, ?, 0, ?, ?, ?, ?)",
+            (user_id, word, translation, language, image_url, association, transcription, datetime.now().isoformat())
         )
-        conn.commit()
         return True
+
+    try:
+        added = await db.transaction(_add)
+        if added:
+            invalidate_user_cache(user_id)
+        return added
     except sqlite3.Error as e:
         print(f"Database error in add_word_to_db: {e}")
         return False
 
 
-def get_user_words(user_id, language=None):
+async def get_user_words(user_id, language=None):
     try:
         # 0-word, 1-translation, 2-language, 3-usage_count, 4-image_url, 5-association, 6-transcription
         query = "SELECT word, translation, language, usage_count, image_url, association, transcription FROM user_words WHERE user_id=?"
@@ -303,90 +1752,443 @@ def get_user_words(user_id, language=None):
             query += " AND language=?"
             params = (user_id, language)
 
-        cursor.execute(query, params)
-        return cursor.fetchall()
+        return await db.fetchall(query, params)
     except sqlite3.Error as e:
         print(f"Database error in get_user_words: {e}")
         return []
 
 
+# Приріст буферизується і потрапляє в БД під час найближчого скидання write_buffer
 def increment_usage_count(user_id, word, language=None):
-    try:
-        cursor.execute(
-            "UPDATE user_words SET usage_count = usage_count + 1 WHERE user_id=? AND word=?",
-            (user_id, word)
-        )
-        conn.commit()
-    except sqlite3.Error as e:
-        print(f"Database error in increment_usage_count: {e}")
+    write_buffer.add_usage(user_id, word)
 
 
-def get_user_level_info(user_id):
-    words = get_user_words(user_id)
-    total_xp = sum([w[3] for w in words])
-    level = 1
-    xp_needed = 10
+# Рівень L потребує 10*L XP, тобто до рівня L сумарно треба 5*L*(L-1) XP.
+# Рівень - найбільше L, для якого 5*L*(L-1) <= XP (розв'язок квадратного рівняння)
+def level_from_xp(total_xp):
+    q = max(total_xp, 0) // 5
+    level = (1 + math.isqrt(1 + 4 * q)) // 2
+    return level, total_xp - 5 * level * (level - 1), 10 * level
+
+
+# Рядки user_stats користувача: (language, word_count, total_xp, last_practiced)
+async def get_user_stats(user_id):
+    try:
+        return await db.fetchall(
+            "SELECT language, word_count, total_xp, last_practiced FROM user_stats "
+            "WHERE user_id=? AND word_count > 0 ORDER BY language", (user_id,))
+    except sqlite3.Error as e:
+        print(f"Database error in get_user_stats: {e}")
+        return []
 
-    while total_xp >= xp_needed:
-        total_xp -= xp_needed
-        level += 1
-        xp_needed += 10
 
-    return level, total_xp, xp_needed
+async def get_user_level_info(user_id):
+    try:
+        row = await db.fetchone("SELECT COALESCE(SUM(total_xp), 0) FROM user_stats WHERE user_id=?", (user_id,))
+    except sqlite3.Error as e:
+        print(f"Database error in get_user_level_info: {e}")
+        row = (0,)
+    return level_from_xp(row[0])
 
 
 # Функція реєстрації нового користувача в базі даних
-def add_user(user_id, username):
+async def add_user(user_id, username):
     try:
-        cursor.execute(
+        await db.execute(
             "INSERT OR IGNORE INTO users (user_id, username, start_date, last_active) VALUES (?, ?, ?, ?)",
             (user_id, username, datetime.now().isoformat(), datetime.now().isoformat())
         )
-        conn.commit()
     except sqlite3.Error as e:
         print(f"Database error in add_user: {e}")
 
 
-# Оновлення часу останньої активності користувача
+# Оновлення часу останньої активності користувача (через буфер відкладеного запису)
 def update_last_active(user_id):
+    write_buffer.touch(user_id)
+
+
+# Які з переданих слів уже є у словнику користувача (перевірка по індексу idx_user_words_lower, без читання всього словника)
+async def filter_known_words(user_id, language, words):
+    known = set()
+    norms = list({w.lower() for w in words})
     try:
-        cursor.execute(
-            "UPDATE users SET last_active=? WHERE user_id=?",
-            (datetime.now().isoformat(), user_id)
-        )
-        conn.commit()
+        for i in range(0, len(norms), SQL_VARS_CHUNK):
+            chunk = norms[i:i + SQL_VARS_CHUNK]
+            rows = await db.fetchall(
+                f"SELECT lower(word) FROM user_words INDEXED BY idx_user_words_lower WHERE user_id=? AND language=? "
+                f"AND lower(word) IN ({','.join('?' * len(chunk))})", (user_id, language, *chunk))
+            known.update(r[0] for r in rows)
     except sqlite3.Error as e:
-        print(f"Database error: {e}")
+        print(f"Database error in filter_known_words: {e}")
+    return known
 
 
 # Видалення слова з бази даних
-def delete_word_from_db(user_id, word):
+async def delete_word_from_db(user_id, word):
     try:
-        cursor.execute("DELETE FROM user_words WHERE user_id=? AND word=?", (user_id, word))
-        conn.commit()
+        await db.execute("DELETE FROM user_words WHERE user_id=? AND word=?", (user_id, word))
+        invalidate_user_cache(user_id)
     except sqlite3.Error as e:
         print(f"Database error in delete_word_from_db: {e}")
 
 
+# Оновлення картинки слова (після регенерації фото)
+async def update_word_image(user_id, word, image_url):
+    try:
+        await db.execute("UPDATE user_words SET image_url=? WHERE user_id=? AND word=?",
+                         (image_url, user_id, word))
+    except sqlite3.Error as e:
+        print(f"Database error in update_word_image: {e}")
+
+
+# Збереження результатів збагачення слова (транскрипція, асоціація, картинка)
+async def update_word_enrichment(user_id, word, language, image_url, association, transcription):
+    try:
+        await db.execute(
+            "UPDATE user_words SET image_url=?, association=?, transcription=? WHERE user_id=? AND word=? AND language=?",
+            (image_url, association, transcription, user_id, word, language))
+    except sqlite3.Error as e:
+        print(f"Database error in update_word_enrichment: {e}")
+
+
+# Рекорд користувача у грі
+async def get_best_score(user_id):
+    try:
+        res = await db.fetchone("SELECT best_score FROM users WHERE user_id=?", (user_id,))
+        return res[0] if res and res[0] else 0
+    except sqlite3.Error as e:
+        print(f"Database error in get_best_score: {e}")
+        return 0
+
+
+# Застосовує один результат гри всередині відкритої транзакції: (applied, count_learned, previous_best)
+def apply_game_rows(conn, user_id, game_id, score, words):
+    # Реєструємо гру першою: INSERT відкриває транзакцію, тож подальше читання рекорду вже в ній
+    cur = conn.execute(
+        "INSERT OR IGNORE INTO game_results (user_id, game_id, score, learned_count, created_at) VALUES (?, ?, ?, 0, ?)",
+        (user_id, game_id, score, datetime.now().isoformat()))
+    res = conn.execute("SELECT best_score FROM users WHERE user_id=?", (user_id,)).fetchone()
+    previous_best = res[0] if res and res[0] else 0
+    if cur.rowcount == 0:
+        # Повтор: нічого не змінюємо і повертаємо збережений рекорд
+        res = conn.execute("SELECT learned_count FROM game_results WHERE user_id=? AND game_id=?",
+                           (user_id, game_id)).fetchone()
+        return False, res[0] if res else 0, previous_best
+
+    count_learned = 0
+    for i in range(0, len(words), SQL_VARS_CHUNK):
+        chunk = words[i:i + SQL_VARS_CHUNK]
+        placeholders = ",".join("?" * len(chunk))
+        cur = conn.execute(
+            f"UPDATE user_words SET usage_count = usage_count + 1 WHERE user_id=? AND word IN ({placeholders})",
+            (user_id, *chunk))
+        count_learned += cur.rowcount
+
+    conn.execute("UPDATE users SET best_score = MAX(COALESCE(best_score, 0), ?) WHERE user_id=?",
+                 (score, user_id))
+    conn.execute("UPDATE game_results SET learned_count=? WHERE user_id=? AND game_id=?",
+                 (count_learned, user_id, game_id))
+    return True, count_learned, previous_best
+
+
+# Унікальні вгадані слова (лише рядки, у порядку вгадування)
+def learned_word_list(learned):
+    return list(dict.fromkeys(w for w in learned if isinstance(w, str)))
+
+
+# Збереження результату гри: лічильники вгаданих слів та рекорд.
+# Усе виконується однією транзакцією; повторно надісланий результат (той самий game_id) ігнорується.
+# Повертає (applied, count_learned, previous_best)
+async def apply_game_result(user_id, game_id, score, learned):
+    words = learned_word_list(learned)
+    result = await db.transaction(lambda conn: apply_game_rows(conn, user_id, game_id, score, words))
+    if result[0]:
+        invalidate_user_cache(user_id)
+    return result
+
+
+# Записи game_results потрібні лише для захисту від повторної доставки, тож старі видаляємо
+GAME_RESULTS_TTL_DAYS = 30
+GAME_RESULTS_PRUNE_EVERY = 60 * 60
+
+
+async def prune_game_results():
+    cutoff = (datetime.now() - timedelta(days=GAME_RESULTS_TTL_DAYS)).isoformat()
+    try:
+        await db.execute("DELETE FROM game_results WHERE created_at < ?", (cutoff,))
+    except sqlite3.Error as e:
+        print(f"Database error in prune_game_results: {e}")
+
+
+async def game_results_pruner():
+    while True:
+        await prune_game_results()
+        await asyncio.sleep(GAME_RESULTS_PRUNE_EVERY)
+
+
+# ПРИЙОМ РЕЗУЛЬТАТІВ ГРИ ЧЕРЕЗ API
+GAME_BATCH_SIZE = 100  # скільки результатів застосувати в одній транзакції
+GAME_BATCH_WINDOW = 0.05  # секунди очікування, щоб зібрати пачку
+GAME_QUEUE_SIZE = 1000
+GAME_RESULT_TIMEOUT = 10  # секунд очікування запису для запиту з Web App
+# Гра триває 60 секунд, найдорожча відповідь дає 8 балів - більший рахунок не може бути справжнім,
+# а занадто велике число не поміститься в INTEGER SQLite
+GAME_MAX_SCORE = 10000
+
+
+# Результати з Web App стають у чергу, а фонова задача застосовує їх пачками в одній транзакції.
+# Кожен запит отримує свій підсумок: рекорд, рівень і XP після запису.
+class GameResultIngestor:
+    def __init__(self, database, batch_size=GAME_BATCH_SIZE, window=GAME_BATCH_WINDOW, queue_size=GAME_QUEUE_SIZE):
+        self.db = database
+        self.batch_size = batch_size
+        self.window = window
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self._task = None
+
+        # Метрики
+        self.accepted = 0
+        self.rejected = 0
+        self.batches = 0
+        self.applied = 0
+        self.duplicates = 0
+        self.errors = 0
+        self.max_batch = 0
+
+    def submit(self, user_id, game_id, score, learned):
+        # Повертає future з підсумком; asyncio.QueueFull, якщо черга переповнена
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((user_id, game_id, score, learned_word_list(learned), future))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise
+        self.accepted += 1
+        return future
+
+    async def _collect(self):
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def apply_batch(self, batch):
+        def _apply(conn):
+            results = []
+            for user_id, game_id, score, words, _ in batch:
+                applied, count_learned, previous_best = apply_game_rows(conn, user_id, game_id, score, words)
+                best = conn.execute("SELECT COALESCE(best_score, 0) FROM users WHERE user_id=?", (user_id,)).fetchone()
+                xp = conn.execute("SELECT COALESCE(SUM(total_xp), 0) FROM user_stats WHERE user_id=?",
+                                  (user_id,)).fetchone()[0]
+                level, level_xp, level_need = level_from_xp(xp)
+                results.append({
+                    "applied": applied,
+                    "score": score,
+                    "learned": count_learned,
+                    "best_score": best[0] if best else score,
+                    "previous_best": previous_best,
+                    "record": applied and score > previous_best,
+                    "level": level,
+                    "xp": level_xp,
+                    "xp_needed": level_need,
+                })
+            return results
+
+        try:
+            results = await self.db.transaction(_apply)
+        except Exception as e:
+            # Будь-яка помилка пачки (не лише sqlite3.Error) завершує лише її запити - фонова задача живе далі
+            print(f"Error in game result batch: {e}")
+            self.errors += 1
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.max_batch = max(self.max_batch, len(batch))
+        for (user_id, *_, future), result in zip(batch, results):
+            if result["applied"]:
+                self.applied += 1
+                invalidate_user_cache(user_id)
+            else:
+                self.duplicates += 1
+            if not future.done():
+                future.set_result(result)
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            await self.apply_batch(batch)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Дописуємо те, що залишилось у черзі
+        while not self.queue.empty():
+            batch = [self.queue.get_nowait() for _ in range(min(self.batch_size, self.queue.qsize()))]
+            await self.apply_batch(batch)
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue.qsize(),
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "batches": self.batches,
+            "applied": self.applied,
+            "duplicates": self.duplicates,
+            "errors": self.errors,
+            "max_batch": self.max_batch,
+        }
+
+
+game_results = GameResultIngestor(db)
+
+
+# ІНТЕРВАЛЬНЕ ПОВТОРЕННЯ (SM-2)
+PRACTICE_SESSION_SIZE = 10
+SRS_RETRY_MINUTES = 10  # через скільки повторити слово після помилки
+SRS_MIN_EASE = 1.3
+
+
+# Новий розклад слова після відповіді: повертає (due_at, ease, interval, reps)
+def sm2_schedule(ease, interval, reps, correct, now=None):
+    now = now or datetime.now()
+    ease = ease or 2.5
+    interval = interval or 0
+    reps = reps or 0
+    quality = 4 if correct else 1
+
+    if quality < 3:
+        reps = 0
+        interval = SRS_RETRY_MINUTES / (24 * 60)
+    else:
+        reps += 1
+        if reps == 1:
+            interval = 1
+        elif reps == 2:
+            interval = 6
+        else:
+            interval = interval * ease
+    ease = max(SRS_MIN_EASE, ease + 0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02))
+
+    due_at = (now + timedelta(days=interval)).isoformat()
+    return due_at, round(ease, 3), round(interval, 4), reps
+
+
+# Мови, які є у словнику користувача
+async def get_user_languages(user_id):
+    try:
+        rows = await db.fetchall(
+            "SELECT language FROM user_stats WHERE user_id=? AND word_count > 0 AND language != '' ORDER BY language",
+            (user_id,))
+        return [r[0] for r in rows]
+    except sqlite3.Error as e:
+        print(f"Database error in get_user_languages: {e}")
+        return []
+
+
+# Сесія практики: слова, яким найраніше настав час повторення (LIMIT по індексу due_at)
+async def get_due_words(user_id, language=None, limit=PRACTICE_SESSION_SIZE):
+    try:
+        # 0-word, 1-translation, 2-language, 3-usage_count, 4-image_url, 5-association, 6-transcription,
+        # 7-ease, 8-interval, 9-reps
+        query = ("SELECT word, translation, language, usage_count, image_url, association, transcription, "
+                 "ease, interval, reps FROM user_words WHERE user_id=?")
+        params = (user_id,)
+        if language is not None:
+            query += " AND language=?"
+            params = (user_id, language)
+        query += " ORDER BY due_at LIMIT ?"
+        return await db.fetchall(query, (*params, limit))
+    except sqlite3.Error as e:
+        print(f"Database error in get_due_words: {e}")
+        return []
+
+
+# Одне слово для практики за ключем (word, language) - сесія в FSM зберігає лише ключі
+async def get_practice_word(user_id, word, language):
+    try:
+        return await db.fetchone(
+            "SELECT word, translation, language, usage_count, image_url, association, transcription, "
+            "ease, interval, reps FROM user_words WHERE user_id=? AND word=? AND language=?",
+            (user_id, word, language))
+    except sqlite3.Error as e:
+        print(f"Database error in get_practice_word: {e}")
+        return None
+
+
+# Запис результату повторення (через буфер відкладеного запису)
+def record_review(user_id, word, language, ease, interval, reps, correct):
+    write_buffer.schedule(user_id, word, language, *sm2_schedule(ease, interval, reps, correct))
+
+
 # ДИНАМІЧНА КЛАВІАТУРА
+GAME_WORDS_LIMIT = 50
+
+# Кеш готових клавіатур: user_id -> ReplyKeyboardMarkup.
+# Скидається лише тоді, коли змінюються слова користувача або їх usage_count.
+kb_cache = LRUCache(maxsize=10000)
+# Версія даних користувача: захищає кеш від запису клавіатури, зібраної до змін
+kb_versions = {}
+
+
+def invalidate_user_cache(user_id):
+    kb_versions[user_id] = kb_versions.get(user_id, 0) + 1
+    kb_cache.pop(user_id, None)
+
+
+# 50 найменш вивчених слів (сортування та ліміт - на боці SQL, по індексу)
+async def get_game_words(user_id, limit=GAME_WORDS_LIMIT):
+    try:
+        return await db.fetchall(
+            "SELECT word, translation FROM user_words WHERE user_id=? ORDER BY usage_count LIMIT ?",
+            (user_id, limit))
+    except sqlite3.Error as e:
+        print(f"Database error in get_game_words: {e}")
+        return []
+
+
 # Генерує посилання на гру з 50 найменш вивченими словами
-def get_main_kb(user_id):
-    words_raw = get_user_words(user_id)
-    game_words = []
-
-    if words_raw:
-        words_raw.sort(key=lambda x: x[3])
-        sample = words_raw[:50]
-        for w in sample:
-            game_words.append({"w": w[0], "t": w[1]})
-
-    # Кодуємо в JSON для URL
-    if game_words:
-        json_data = json.dumps(game_words)
-        encoded_data = urllib.parse.quote(json_data)
-        game_url = f"{WEB_APP_URL}?data={encoded_data}"
+async def get_main_kb(user_id):
+    kb = kb_cache.get(user_id)
+    if kb is not None:
+        return kb
+
+    version = kb_versions.get(user_id, 0)
+    if PUBLIC_URL:
+        # Гра сама завантажує колоду з /deck - у посиланні лише адреса API
+        game_url = f"{WEB_APP_URL}?api={urllib.parse.quote(PUBLIC_URL, safe='')}"
     else:
-        game_url = WEB_APP_URL
+        game_words = [{"w": w[0], "t": w[1]} for w in await get_game_words(user_id)]
+
+        # Кодуємо в JSON для URL
+        if game_words:
+            json_data = json.dumps(game_words)
+            encoded_data = urllib.parse.quote(json_data)
+            game_url = f"{WEB_APP_URL}?data={encoded_data}"
+        else:
+            game_url = WEB_APP_URL
 
     kb = types.ReplyKeyboardMarkup(
         keyboard=[
@@ -397,9 +2199,150 @@ def get_main_kb(user_id):
             [types.KeyboardButton(text="/AI"), types.KeyboardButton(text="/exit")]
         ], resize_keyboard=True
     )
+
+    # Якщо поки ми читали БД дані змінились - не кешуємо застарілу клавіатуру
+    if kb_versions.get(user_id, 0) == version:
+        kb_cache[user_id] = kb
     return kb
 
 
+# API ДЛЯ WEB APP
+INIT_DATA_MAX_AGE = 24 * 60 * 60  # скільки секунд дійсні initData після відкриття гри
+DECK_CACHE_TTL = 10 * 60
+# Сторінка гри живе на іншому домені, тому браузер спершу питає дозвіл (CORS)
+CORS_ORIGIN = "{0.scheme}://{0.netloc}".format(urllib.parse.urlsplit(WEB_APP_URL)) if WEB_APP_URL else "*"
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": CORS_ORIGIN,
+    "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+    "Access-Control-Allow-Headers": "X-Telegram-Init-Data, Content-Type, If-None-Match",
+    "Access-Control-Expose-Headers": "ETag",
+    "Access-Control-Max-Age": "86400",
+    "Vary": "Origin",
+}
+
+
+# Перевіряє підпис initData (HMAC від токена бота) та їх свіжість; повертає id користувача або None
+def web_app_user_id(request):
+    init_data = request.headers.get("X-Telegram-Init-Data", "")
+    if not init_data:
+        return None
+    try:
+        data = safe_parse_webapp_init_data(TELEGRAM_BOT_TOKEN, init_data)
+    except ValueError:
+        return None
+    if data.user is None or time.time() - data.auth_date.timestamp() > INIT_DATA_MAX_AGE:
+        return None
+    return data.user.id
+
+
+def api_error(status, text):
+    return web.json_response({"error": text}, status=status, headers=CORS_HEADERS)
+
+
+async def cors_preflight(request):
+    return web.Response(status=204, headers=CORS_HEADERS)
+
+
+# Готові колоди гри: user_id -> (підпис даних, ETag, JSON, JSON у gzip).
+# Підпис - кількість слів і сума usage_count з user_stats: змінюється разом зі словами користувача,
+# а перевіряється одним запитом по первинному ключу. TTL обмежує застарівання для правок, які суми не змінюють.
+class DeckCache:
+    def __init__(self, maxsize=10000, ttl=DECK_CACHE_TTL):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    async def signature(self, user_id):
+        try:
+            row = await db.fetchone(
+                "SELECT COALESCE(SUM(word_count), 0), COALESCE(SUM(total_xp), 0) FROM user_stats WHERE user_id=?",
+                (user_id,))
+        except sqlite3.Error as e:
+            print(f"Database error in DeckCache.signature: {e}")
+            return None
+        return (kb_versions.get(user_id, 0), *row)
+
+    async def get(self, user_id):
+        signature = await self.signature(user_id)
+        entry = self.cache.get(user_id)
+        if entry is not None and signature is not None and entry[0] == signature:
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        words = [{"w": w[0], "t": w[1]} for w in await get_game_words(user_id)]
+        body = json.dumps({"words": words}, ensure_ascii=False, separators=(",", ":")).encode()
+        etag = 'W/"%s"' % hashlib.sha1(body).hexdigest()
+        entry = (signature, etag, body, gzip.compress(body))
+        if signature is not None:
+            self.cache[user_id] = entry
+        return entry
+
+    def stats(self):
+        return {
+            "size": len(self.cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "not_modified": self.not_modified,
+        }
+
+
+deck_cache = DeckCache()
+
+
+# Колода для гри: 50 найменш вивчених слів користувача, якого підтвердили initData
+async def deck_handler(request):
+    user_id = web_app_user_id(request)
+    if user_id is None:
+        return api_error(401, "invalid init data")
+
+    _, etag, body, compressed = await deck_cache.get(user_id)
+    headers = {**CORS_HEADERS, "ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Origin, Accept-Encoding"}
+
+    if etag in (tag.strip() for tag in request.headers.get("If-None-Match", "").split(",")):
+        deck_cache.not_modified += 1
+        return web.Response(status=304, headers=headers)
+
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        body = compressed
+    return web.Response(body=body, content_type="application/json", charset="utf-8", headers=headers)
+
+
+# Результат гри з Web App: записується пачкою разом з іншими, у відповідь - рекорд і рівень
+async def game_result_handler(request):
+    user_id = web_app_user_id(request)
+    if user_id is None:
+        return api_error(401, "invalid init data")
+
+    try:
+        data = await request.json()
+        game_id = data["game_id"]
+        score = int(data.get("score", 0))
+        learned = data.get("learned_words", [])
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return api_error(400, "invalid result")
+    if (not isinstance(game_id, str) or not 0 < len(game_id) <= 64 or not 0 <= score <= GAME_MAX_SCORE
+            or not isinstance(learned, list)):
+        return api_error(400, "invalid result")
+
+    # Той самий антиспам, що й для повідомлень: без затримки, понад ліміт - відмова
+    if await throttling.take(user_id, "game", max_delay=0) is None:
+        return api_error(429, "too many requests")
+
+    try:
+        result = await asyncio.wait_for(game_results.submit(user_id, game_id, score, learned[:GAME_WORDS_LIMIT]),
+                                        GAME_RESULT_TIMEOUT)
+    except (asyncio.QueueFull, asyncio.TimeoutError):
+        # Результат із тим самим game_id можна надіслати ще раз - повтор не зарахується двічі
+        return api_error(503, "busy")
+    except Exception as e:
+        print(f"Error in game_result_handler: {e}")
+        return api_error(500, "internal error")
+    return web.json_response(result, headers=CORS_HEADERS)
+
+
 # Визначення станів (FSM) для процесу додавання слова
 class AddWord(StatesGroup):
     waiting_for_word = State()
@@ -435,11 +2378,164 @@ class WordOfDayState(StatesGroup):
     waiting_for_action = State()  # Стан очікування дії (додати/далі)
 
 
+# АНТИСПАМ (token bucket)
+# Кожен користувач має "відро" токенів для кожного класу обробників: токени поповнюються з швидкістю rate
+# на секунду до capacity, кожне повідомлення забирає один. Якщо токена немає, але чекати недовго
+# (до RATE_MAX_DELAY) - повідомлення затримується, інакше відкидається.
+# Клас задається прапорцем обробника: @router.message(..., flags={"rate": "expensive"}).
+# Позначаються саме ті кроки діалогу, що звертаються до сервісів, а не команди, з яких діалог починається
+RATE_LIMITS = {
+    "default": (1.0, 3),  # (токенів за секунду, розмір відра)
+    "expensive": (1 / 10, 2),  # обробники, що звертаються до ШІ/картинок
+    "translate": (1 / 5, 3),  # автопереклад слова
+    "game": (1 / 30, 3),  # результати гри через API (одна гра триває 60 секунд)
+}
+RATE_MAX_DELAY = 1.0  # секунд
+RATE_CLEANUP_EVERY = 60  # як часто прибирати повні (неактивні) відра
+
+
+# Відра в пам'яті процесу - той самий TokenBucket, що й для ключів Gemini
+class MemoryRateBackend:
+    def __init__(self):
+        self._buckets = {}  # key -> TokenBucket
+        self._last_cleanup = time.monotonic()
+
+    async def take(self, key, rate, capacity, max_delay):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(rate * 60, capacity)
+        wait = bucket.take(max_delay)
+        now = time.monotonic()
+        if now - self._last_cleanup >= RATE_CLEANUP_EVERY:
+            self._cleanup(now)
+        return wait
+
+    def _cleanup(self, now):
+        # Відро, яке вже наповнилось до кінця, нічим не відрізняється від відсутнього
+        for key, bucket in list(self._buckets.items()):
+            if bucket.is_full():
+                del self._buckets[key]
+        self._last_cleanup = now
+
+    def size(self):
+        return len(self._buckets)
+
+
+# Відра в words.db: спільні для всіх процесів і реплік, що працюють з одним файлом.
+# Перевірка і списання токена - один атомарний UPSERT
+class SQLiteRateBackend:
+    SQL = """
+    INSERT INTO rate_buckets (key, tokens, updated) VALUES (:key, :capacity - 1, :now)
+    ON CONFLICT(key) DO UPDATE SET
+        tokens = CASE WHEN MIN(:capacity, tokens + (:now - updated) * :rate) - 1 >= -:max_delay * :rate
+                      THEN MIN(:capacity, tokens + (:now - updated) * :rate) - 1 ELSE tokens END,
+        updated = CASE WHEN MIN(:capacity, tokens + (:now - updated) * :rate) - 1 >= -:max_delay * :rate
+                       THEN :now ELSE updated END
+    RETURNING tokens, updated
+    """
+
+    def __init__(self, database):
+        self.db = database
+        self._last_cleanup = time.time()
+
+    async def take(self, key, rate, capacity, max_delay):
+        now = time.time()
+        params = {"key": key, "capacity": capacity, "now": now, "rate": rate, "max_delay": max_delay}
+        tokens, updated = await self.db.transaction(lambda conn: conn.execute(self.SQL, params).fetchone())
+        if now - self._last_cleanup >= RATE_CLEANUP_EVERY:
+            self._last_cleanup = now
+            # За годину будь-яке відро вже повне
+            await self.db.execute("DELETE FROM rate_buckets WHERE updated < ?", (now - 3600,))
+        if updated != now:
+            return None
+        return max(0.0, -tokens / rate)
+
+    def size(self):
+        return None
+
+
+# Redis (або сумісний сервер: KeyDB, Valkey...) - та сама логіка в Lua-скрипті, виконується атомарно
+class RedisRateBackend:
+    SCRIPT = """
+    local capacity = tonumber(ARGV[1])
+    local rate = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local max_delay = tonumber(ARGV[4])
+    local bucket = redis.call('HMGET', KEYS[1], 't', 'u')
+    local tokens = tonumber(bucket[1]) or capacity
+    local updated = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + (now - updated) * rate) - 1
+    if tokens < -max_delay * rate then
+        return false
+    end
+    redis.call('HSET', KEYS[1], 't', tostring(tokens), 'u', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate + max_delay) + 1)
+    return tostring(tokens)
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._script = client.register_script(self.SCRIPT)
+
+    async def take(self, key, rate, capacity, max_delay):
+        result = await self._script(keys=[f"rate:{key}"], args=[capacity, rate, time.time(), max_delay])
+        if result is None:
+            return None
+        return max(0.0, -float(result) / rate)
+
+    def size(self):
+        return None
+
+
+def create_rate_backend(name):
+    if name == "redis":
+        if redis is not None:
+            return RedisRateBackend(redis.from_url(REDIS_URL))
+        print("⚠️ Пакет redis не встановлено, антиспам працює в пам'яті")
+    elif name == "sqlite":
+        return SQLiteRateBackend(db)
+    return MemoryRateBackend()
+
+
 # Middleware для обмеження частоти запитів (Anti-spam)
 class ThrottlingMiddleware(BaseMiddleware):
 
-    def __init__(self, throttle_time: int = 1):
-        self.cache = TTLCache(maxsize=10000, ttl=throttle_time)
+    def __init__(self, backend, limits=RATE_LIMITS, max_delay=RATE_MAX_DELAY):
+        self.backend = backend
+        self.limits = limits
+        self.max_delay = max_delay
+        self.counters = {name: {"allowed": 0, "delayed": 0, "dropped": 0} for name in limits}
+        # Кому вже відповіли "забагато запитів": не частіше ніж раз за час повного наповнення "дорогого" відра
+        rate, capacity = limits["expensive"]
+        self._notified = TTLCache(maxsize=10000, ttl=capacity / rate)
+        self.total_delay = 0.0
+        self.errors = 0
+
+    # Списує токен користувача для класу name: час очікування, 0 або None (відкинути).
+    # Використовується і для повідомлень, і для запитів від Web App
+    async def take(self, user_id, name, max_delay=None):
+        rate, capacity = self.limits[name]
+        max_delay = self.max_delay if max_delay is None else max_delay
+        try:
+            wait = await self.backend.take(f"{user_id}:{name}", rate, capacity, max_delay)
+        except Exception as e:
+            # Сховище недоступне - краще пропустити повідомлення, ніж зупинити бота
+            print(f"Error in rate limiter: {e}")
+            self.errors += 1
+            wait = 0.0
+
+        counters = self.counters[name]
+        if wait is None:
+            counters["dropped"] += 1
+        elif wait > 0:
+            counters["delayed"] += 1
+        else:
+            counters["allowed"] += 1
+        return wait
+
+    def limit_name(self, data):
+        name = get_flag(data, "rate")
+        return name if name in self.limits else "default"
 
     async def __call__(
             self,
@@ -451,13 +2547,52 @@ class ThrottlingMiddleware(BaseMiddleware):
         if not isinstance(event, types.Message) or not event.from_user:
             return await handler(event, data)
 
-        user_id = event.from_user.id
-
-        if user_id in self.cache:
+        name = self.limit_name(data)
+        wait = await self.take(event.from_user.id, name)
+        if wait is None:
+            if name != "default" and event.from_user.id not in self._notified:
+                self._notified[event.from_user.id] = True
+                await event.answer("⏳ Забагато запитів. Спробуйте трохи пізніше.")
             return
-        else:
-            self.cache[user_id] = True
+        if wait > 0:
+            self.total_delay += wait
+            await asyncio.sleep(wait)
+        return await handler(event, data)
+
+    def stats(self):
+        return {
+            "backend": type(self.backend).__name__,
+            "buckets": self.backend.size(),
+            "errors": self.errors,
+            "total_delay_s": round(self.total_delay, 2),
+            **self.counters,
+        }
+
+
+throttling = ThrottlingMiddleware(create_rate_backend(RATE_LIMIT_BACKEND))
+
+
+# Middleware: час виконання та помилки кожного обробника (мітка - назва функції-обробника)
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(
+            self,
+            handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: types.TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+        started = time.perf_counter()
+        try:
             return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, name)
+
+
+handler_metrics = HandlerMetricsMiddleware()
 
 
 # Текст з описом команд для користувача
@@ -482,10 +2617,10 @@ SUPPORTED_LANGUAGES = ["English", "German", "French", "Polish", "Spanish", "Ital
 # Обробник команди /start
 @router.message(Command("start"))
 async def cmd_start(message: types.Message, state: FSMContext):
-    add_user(message.from_user.id, message.from_user.username)
+    await add_user(message.from_user.id, message.from_user.username)
     update_last_active(message.from_user.id)
     await state.clear()
-    kb = get_main_kb(message.from_user.id)
+    kb = await get_main_kb(message.from_user.id)
     await message.answer(f"👋 Привіт!\nСпробуй нову гру 👇\n\n{COMMANDS_TEXT}", reply_markup=kb)
 
 
@@ -495,12 +2630,12 @@ async def cmd_exit(message: types.Message, state: FSMContext):
     update_last_active(message.from_user.id)
     current_state = await state.get_state()
     if current_state is None:
-        kb = get_main_kb(message.from_user.id)
+        kb = await get_main_kb(message.from_user.id)
         await message.answer("🚪 Зараз жоден з режимів не активний.", reply_markup=kb)
         return
 
     await state.clear()
-    kb = get_main_kb(message.from_user.id)
+    kb = await get_main_kb(message.from_user.id)
     await message.answer(f"🚪 Ви вийшли з режиму.\n\n{COMMANDS_TEXT}", reply_markup=kb)
 
 
@@ -526,20 +2661,26 @@ async def callback_regenerate(callback: types.CallbackQuery, state: FSMContext):
 
         # Якщо це режим додавання слова, оновлюємо і в БД
         if mode == 'add' and data.get('word'):
-            cursor.execute("UPDATE user_words SET image_url=? WHERE user_id=? AND word=?",
-                           (new_url, callback.from_user.id, data['word']))
-            conn.commit()
+            await update_word_image(callback.from_user.id, data['word'], new_url)
 
         # Для Word of Day оновлюємо стан
         if mode == 'wod':
             await state.update_data(image_url=new_url)
 
         # Оновлюємо повідомлення
-        caption = callback.message.caption
-        await callback.message.edit_media(
-            media=types.InputMediaPhoto(media=new_url, caption=caption, parse_mode="HTML"),
-            reply_markup=callback.message.reply_markup
-        )
+        if callback.message.photo:
+            caption = callback.message.caption
+            await callback.message.edit_media(
+                media=types.InputMediaPhoto(media=new_url, caption=caption, parse_mode="HTML"),
+                reply_markup=callback.message.reply_markup
+            )
+        else:
+            # Текстове повідомлення з картинкою у прев'ю (див. text_with_image)
+            text = (callback.message.text or "").lstrip("\u200b")
+            await callback.message.edit_text(
+                text_with_image(text, new_url), parse_mode="HTML",
+                reply_markup=callback.message.reply_markup
+            )
         await callback.answer("Фото оновлено!")
 
     except Exception as e:
@@ -550,35 +2691,34 @@ async def callback_regenerate(callback: types.CallbackQuery, state: FSMContext):
 # ОБРОБКА ДАНИХ З ГРИ (WEB APP)
 @router.message(F.content_type == types.ContentType.WEB_APP_DATA)
 async def process_web_app_data(message: types.Message):
-    data = json.loads(message.web_app_data.data)
+    raw = message.web_app_data.data
+    data = json.loads(raw)
 
     if data.get('type') == 'game_result':
-        score = data.get('score', 0)
+        score = int(data.get('score', 0))
         learned = data.get('learned_words', [])
         user_id = message.from_user.id
+        if not 0 <= score <= GAME_MAX_SCORE:
+            await message.answer("❌ Некоректний результат гри.", reply_markup=await get_main_kb(user_id))
+            return
+        # Старі версії гри не передають game_id. Тоді беремо id службового повідомлення: повторна доставка
+        # того самого оновлення має той самий id, а дві однакові, але різні ігри - різні
+        game_id = str(data.get('game_id') or f"msg:{message.message_id}")
 
-        # Оновлюємо статистику кожного вгаданого слова
-        count_learned = 0
-        for word_text in learned:
-            cursor.execute("UPDATE user_words SET usage_count = usage_count + 1 WHERE user_id=? AND word=?",
-                           (user_id, word_text))
-            if cursor.rowcount > 0: count_learned += 1
-        conn.commit()
+        # Оновлюємо статистику кожного вгаданого слова та рекорд користувача
+        applied, count_learned, current_best = await apply_game_result(user_id, game_id, score, learned)
 
-        # Оновлюємо рекорд користувача
-        cursor.execute("SELECT best_score FROM users WHERE user_id=?", (user_id,))
-        res = cursor.fetchone()
-        current_best = res[0] if res and res[0] else 0
+        if not applied:
+            await message.answer("⚠️ Цей результат гри вже збережено.", reply_markup=await get_main_kb(user_id))
+            return
 
         msg = f"🎮 <b>Результат гри:</b> {score} балів!"
         msg += f"\n📚 Слів повторено: {count_learned}"
 
         if score > current_best:
-            cursor.execute("UPDATE users SET best_score=? WHERE user_id=?", (score, user_id))
-            conn.commit()
             msg += f"\n🏆 <b>Новий рекорд!</b> (Було: {current_best})"
 
-        kb = get_main_kb(user_id)
+        kb = await get_main_kb(user_id)
         await message.answer(msg, parse_mode="HTML", reply_markup=kb)
 
 
@@ -586,7 +2726,7 @@ async def process_web_app_data(message: types.Message):
 @router.message(Command("add_word"))
 async def cmd_add_word(message: types.Message, state: FSMContext):
     update_last_active(message.from_user.id)
-    kb = get_main_kb(message.from_user.id)
+    kb = await get_main_kb(message.from_user.id)
     await state.set_state(AddWord.waiting_for_word)
     await message.answer("✏️ Введіть слово для додавання:", reply_markup=kb)
 
@@ -616,7 +2756,7 @@ async def process_word(message: types.Message, state: FSMContext):
 
 
 # Обробка вибору мови та збереження слова
-@router.message(AddWord.waiting_for_language)
+@router.message(AddWord.waiting_for_language, flags={"rate": "translate"})
 async def process_language(message: types.Message, state: FSMContext):
     update_last_active(message.from_user.id)
     language = message.text.strip()
@@ -634,8 +2774,10 @@ async def process_language(message: types.Message, state: FSMContext):
     word = data.get("word")
 
     try:
-        translator = GoogleTranslator(source='auto', target="uk")
-        auto_translation = translator.translate(data['word'])
+        auto_translation = await translation_service.translate(data['word'], language)
+    except UpstreamBusy:
+        # Перекладач перевантажений: відповідає upstream_busy_handler, мову можна обрати ще раз
+        raise
     except Exception:
         auto_translation = "Error"
 
@@ -655,8 +2797,76 @@ async def process_language(message: types.Message, state: FSMContext):
     )
 
 
+ENRICH_TIMEOUT = 20  # секунд на пошук асоціації та картинки у фоні
+
+# Посилання на фонові задачі, щоб їх не прибрав збирач сміття
+background_tasks = set()
+
+
+def spawn_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+# При зупинці даємо фоновим задачам (збагачення щойно доданих слів) завершитись, поки працюють БД і сесія бота;
+# те, що не встигло за timeout, скасовуємо
+async def drain_background(timeout=ENRICH_TIMEOUT + 5):
+    if not background_tasks:
+        return
+    print(f"⏳ Чекаємо фонові задачі: {len(background_tasks)}")
+    done, pending = await asyncio.wait(set(background_tasks), timeout=timeout)
+    for task in pending:
+        task.cancel()
+    if pending:
+        await asyncio.wait(pending)
+
+
+# Текст повідомлення з картинкою у вигляді прихованого посилання:
+# Telegram покаже її в прев'ю, а текстове повідомлення можна редагувати на місці
+def text_with_image(text, image_url):
+    if not image_url:
+        return html.escape(text)
+    return f'<a href="{html.escape(image_url)}">&#8203;</a>{html.escape(text)}'
+
+
+# Фонове збагачення щойно доданого слова: ШІ + Pixabay, потім оновлення БД і повідомлення
+async def enrich_added_word(sent, state, user_id, word, translation, language, inline_kb):
+    async def _enrich():
+        transcription, association, visual_prompt = await get_full_word_info(word, translation, language)
+        search_query = visual_prompt if visual_prompt else word
+        image_url = await get_image_url(search_query)
+        return transcription, association, search_query, image_url
+
+    try:
+        transcription, association, search_query, image_url = await asyncio.wait_for(_enrich(), ENRICH_TIMEOUT)
+    except Exception as e:
+        print(f"Enrichment error ({word}): {e}")
+        try:
+            await sent.edit_text(f"✅ Додано: {word} — {translation}")
+        except Exception:
+            pass
+        return
+
+    await update_word_enrichment(user_id, word, language, image_url, association, transcription)
+
+    # Зберігаємо для регенерації, якщо користувач ще не перейшов до іншого слова
+    data = await state.get_data()
+    if data.get("word") == word:
+        await state.update_data(img_query=search_query)
+
+    text = f"✅ Додано: {word} {transcription} — {translation}"
+    if association:
+        text += f"\n🧠 Асоціація: {association}"
+    try:
+        await sent.edit_text(text_with_image(text, image_url), parse_mode="HTML", reply_markup=inline_kb)
+    except Exception as e:
+        print(f"Enrichment edit error: {e}")
+
+
 # 2. Зберігаємо фінальний варіант переклада
-@router.message(AddWord.waiting_for_translation)
+@router.message(AddWord.waiting_for_translation, flags={"rate": "expensive"})
 async def process_custom_translation(message: types.Message, state: FSMContext):
     update_last_active(message.from_user.id)
     user_input = message.text.strip()
@@ -671,40 +2881,304 @@ async def process_custom_translation(message: types.Message, state: FSMContext):
     language = data.get("language")
     auto_translation = data.get("auto_translation")
     final_translation = auto_translation if message.text.startswith("Зберегти:") else message.text
-    await message.answer("⏳ Зберігаю, шукаю картинку та генерую асоціацію...")
-    transcription, association, visual_prompt = await get_full_word_info(word, final_translation, language)
-    search_query = visual_prompt if visual_prompt else word
-    image_url = await get_image_url(search_query)
 
-    # Зберігаємо для регенерації
-    await state.update_data(img_query=search_query)
+    # Зберігаємо слово одразу лише з перекладом, а асоціацію та картинку додаємо у фоні
+    added = await add_word_to_db(user_id, word, final_translation, language)
 
-    added = add_word_to_db(message.from_user.id, word, final_translation, language, image_url, association,
-                           transcription)
-
-    kb = get_main_kb(message.from_user.id)
+    kb = await get_main_kb(user_id)
     if not added:
         await message.answer(f"⚠️ Слово '{word}' вже є у вашому словнику.", reply_markup=kb)
     else:
-        text = f"✅ Додано: {word} {transcription} — {final_translation}"
-        if association:
-            text += f"\n🧠 Асоціація: {association}"
+        await state.update_data(img_query=None)
+        sent = await message.answer(f"✅ Додано: {word} — {final_translation}\n⏳ Шукаю картинку та асоціацію...")
 
         # Кнопка регенерації
         inline_kb = types.InlineKeyboardMarkup(inline_keyboard=[
             [types.InlineKeyboardButton(text="🔄 Інше фото", callback_data="regen:add")]
         ])
-
-        if image_url:
-            await message.answer_photo(photo=image_url, caption=text, reply_markup=inline_kb)
-        else:
-            await message.answer(text, reply_markup=inline_kb)
+        spawn_background(enrich_added_word(sent, state, user_id, word, final_translation, language, inline_kb))
 
     await message.answer("👇 Продовжити:", reply_markup=kb)
 
     await state.set_state(AddWord.waiting_for_word)
 
 
+# СЛОВО ДНЯ: ПУЛ ГОТОВИХ КАНДИДАТІВ
+WOD_LEVELS = ["A1", "B1", "C1"]
+WOD_BATCH = 20  # скільки слів просити у ШІ за один запит
+WOD_POOL_SIZE = 40  # скільки кандидатів тримати для кожної пари мова × рівень
+WOD_POOL_LOW = 20  # нижче цього - поповнюємо
+WOD_REFILL_INTERVAL = 60  # секунд між плановими перевірками пулу
+WOD_PRODUCER_DELAY = 2  # пауза між генераціями, щоб не забирати ліміти Gemini у користувачів
+WOD_GEMINI_RESERVE = 0.5  # частка запасу токенів Gemini, яку фонове поповнення завжди залишає користувачам
+WOD_BUDGET_POLL = 1.0  # як часто перевіряти, чи з'явився запас
+WOD_BACKOFF_MIN = 30  # пауза після невдалого поповнення кошика, далі подвоюється
+WOD_BACKOFF_MAX = 30 * 60
+WOD_ENRICH_CONCURRENCY = 4
+
+# Залишок кандидатів для конкретного користувача: (user_id, мова, рівень) -> [кандидати]
+wod_user_cache = TTLCache(maxsize=10000, ttl=60 * 60)
+
+WOD_COLUMNS = "word, translation, transcription, association, image_url, img_query"
+
+
+def wod_difficulty(level):
+    return "A1" if level <= 3 else "B1" if level <= 8 else "C1"
+
+
+def wod_row_to_candidate(row):
+    return dict(zip(("word", "translation", "transcription", "association", "image_url", "img_query"), row))
+
+
+# Розбір JSON-відповіді ШІ: [{"word": ..., "translation": ...}, ...]
+def parse_word_batch(text):
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.strip("`")
+        text = text[text.find("["):]
+    try:
+        items = json.loads(text)
+    except ValueError:
+        return []
+    pairs = []
+    for item in items if isinstance(items, list) else []:
+        if isinstance(item, dict) and item.get("word") and item.get("translation"):
+            pairs.append((str(item["word"]).strip().replace("*", ""), str(item["translation"]).strip()))
+    return pairs
+
+
+# Фоновий виробник тримає для кожної мови та рівня запас повністю готових слів
+# (слово, переклад, транскрипція, асоціація, картинка) у таблиці wod_pool.
+# Слова генеруються пачками (один запит до ШІ на WOD_BATCH слів), а відсіювання слів,
+# які вже є у словнику користувача, робиться в SQL (anti-join по індексу).
+class WordOfDayPool:
+    def __init__(self, database, languages, levels, size=WOD_POOL_SIZE, low=WOD_POOL_LOW):
+        self.db = database
+        self.size = size
+        self.low = low
+        self.buckets = [(lang, lvl) for lang in languages for lvl in levels]
+        self.counts = {b: 0 for b in self.buckets}
+        self._wanted = set()  # кошики, які вичерпались для когось із користувачів
+        self._wakeup = asyncio.Event()
+        self._enrich_sem = asyncio.Semaphore(WOD_ENRICH_CONCURRENCY)
+        self._task = None
+        self._closing = False
+
+        self.served = 0
+        self.user_cache_hits = 0
+        self.pool_misses = 0
+        self.batches = 0
+        self.generated = 0
+        self.degraded = 0
+        self.errors = 0
+        self.budget_wait = 0.0
+        self._backoff = {}  # кошик -> поточна пауза після невдалих поповнень
+        self._retry_at = {}  # кошик -> коли можна пробувати знову
+
+    # Один запит до ШІ - список пар (слово, переклад), без слів з exclude
+    async def generate_words(self, lang, level, exclude, count=WOD_BATCH):
+        prompt = (
+            f"Згенеруй {count} різних цікавих слів мовою {lang} для рівня {level}. "
+            f"Важливо: не використовуй ці слова: [{', '.join(list(exclude)[:50])}]. "
+            f'Відповідь суворо у форматі JSON-масиву: [{{"word": "Слово", "translation": "Переклад"}}]. '
+            f"Переклад українською. Без зайвого тексту."
+        )
+        config = genai_types.GenerateContentConfig(response_mime_type="application/json")
+        response = await generate_content_safe(contents=prompt, config=config)
+        self.batches += 1
+
+        pairs = []
+        seen = set(exclude)
+        for word, translation in parse_word_batch(response.text):
+            if word.lower() not in seen:
+                seen.add(word.lower())
+                pairs.append((word, translation))
+        return pairs
+
+    async def enrich(self, lang, word, translation):
+        async with self._enrich_sem:
+            transc, assoc, visual_prompt = await get_full_word_info(word, translation, lang)
+            search_query = visual_prompt if visual_prompt else word
+            image_url = await get_image_url(search_query)
+        self.generated += 1
+        return {
+            "word": word, "translation": translation, "transcription": transc,
+            "association": assoc, "image_url": image_url, "img_query": search_query,
+        }
+
+    # get_full_word_info повертає "[?]", якщо ШІ не відповів (помилка, перевантаження) або відповідь не розібрано.
+    # Такий кандидат можна показати тому, хто чекає, але не класти в спільний пул для всіх
+    def usable(self, candidates):
+        good = [c for c in candidates if c["transcription"] != "[?]"]
+        self.degraded += len(candidates) - len(good)
+        return good
+
+    async def store(self, lang, level, candidates):
+        if not candidates:
+            return
+        now = datetime.now().isoformat()
+
+        def _store(conn):
+            conn.executemany(
+                f"INSERT OR REPLACE INTO wod_pool (language, level, word_norm, {WOD_COLUMNS}, created_at) "
+                f"VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(lang, level, c["word"].lower(), c["word"], c["translation"], c["transcription"],
+                  c["association"], c["image_url"], c["img_query"], now) for c in candidates])
+            # Тримаємо лише size найновіших кандидатів
+            conn.execute(
+                "DELETE FROM wod_pool WHERE language=? AND level=? AND word_norm NOT IN "
+                "(SELECT word_norm FROM wod_pool WHERE language=? AND level=? ORDER BY created_at DESC LIMIT ?)",
+                (lang, level, lang, level, self.size))
+            return conn.execute("SELECT COUNT(*) FROM wod_pool WHERE language=? AND level=?",
+                                (lang, level)).fetchone()[0]
+
+        self.counts[(lang, level)] = await self.db.transaction(_store)
+
+    # Фонове поповнення має нижчий пріоритет за запити користувачів: чекаємо, поки в Gemini є запас
+    async def wait_for_budget(self):
+        while not key_pool.has_spare(WOD_GEMINI_RESERVE):
+            self.budget_wait += WOD_BUDGET_POLL
+            await asyncio.sleep(WOD_BUDGET_POLL)
+
+    # По одному слову, кожне - лише коли є запас токенів; готові кандидати одразу потрапляють у пул
+    async def enrich_and_store(self, lang, level, pairs):
+        stored = 0
+        for word, translation in pairs:
+            await self.wait_for_budget()
+            candidates = self.usable([await self.enrich(lang, word, translation)])
+            await self.store(lang, level, candidates)
+            stored += len(candidates)
+        return stored
+
+    async def refill(self, lang, level):
+        rows = await self.db.fetchall("SELECT word_norm FROM wod_pool WHERE language=? AND level=?", (lang, level))
+        await self.wait_for_budget()
+        pairs = await self.generate_words(lang, level, {r[0] for r in rows})
+        return await self.enrich_and_store(lang, level, pairs)
+
+    # Кошик, поповнення якого нічого не дало (помилка, перевантаження), пробуємо знову з наростаючою паузою
+    def schedule_retry(self, bucket, stored):
+        if stored:
+            self._backoff.pop(bucket, None)
+            self._retry_at.pop(bucket, None)
+            return
+        delay = min(self._backoff.get(bucket, WOD_BACKOFF_MIN / 2) * 2, WOD_BACKOFF_MAX)
+        self._backoff[bucket] = delay
+        self._retry_at[bucket] = time.monotonic() + delay
+
+    # Кандидати для користувача: без слів з його словника (anti-join) та вже показаних у сесії
+    async def fetch_for_user(self, user_id, lang, level, seen, limit=WOD_BATCH):
+        seen = list(seen)[:SQL_VARS_CHUNK]
+        rows = await self.db.fetchall(
+            f"SELECT {WOD_COLUMNS} FROM wod_pool p WHERE p.language=? AND p.level=? "
+            f"AND p.word_norm NOT IN ({','.join('?' * len(seen))}) "
+            # Без статистики (ANALYZE) планувальник обирає індекс первинного ключа і перебирає весь словник,
+            # тому індекс вказано явно; "+" знімає affinity колонки, інакше в пошуку не бере участь lower(word)
+            f"AND NOT EXISTS (SELECT 1 FROM user_words u INDEXED BY idx_user_words_lower "
+            f"WHERE u.user_id=? AND u.language=p.language AND lower(u.word)=+p.word_norm) "
+            f"ORDER BY random() LIMIT ?",
+            (lang, level, *seen, user_id, limit))
+        if not rows:
+            self.pool_misses += 1
+            self._wanted.add((lang, level))
+            self._wakeup.set()
+        return [wod_row_to_candidate(r) for r in rows]
+
+    # Наступне слово дня для користувача: спершу з його залишку, потім з пулу
+    async def next_for_user(self, user_id, lang, level, seen):
+        key = (user_id, lang, level)
+        leftovers = [c for c in wod_user_cache.get(key, []) if c["word"].lower() not in seen]
+        if leftovers:
+            self.user_cache_hits += 1
+        else:
+            leftovers = await self.fetch_for_user(user_id, lang, level, seen)
+        if not leftovers:
+            return None
+        self.served += 1
+        wod_user_cache[key] = leftovers[1:]
+        return leftovers[0]
+
+    # Генерація напряму, коли пул для користувача порожній:
+    # одне слово збагачуємо одразу, решту пачки - у фоні в пул
+    async def generate_for_user(self, user_id, lang, level, seen):
+        pairs = await self.generate_words(lang, level, seen)
+        known = await filter_known_words(user_id, lang, [w for w, _ in pairs])
+        pairs = [(w, t) for w, t in pairs if w.lower() not in known]
+        if not pairs:
+            return None
+        candidate = await self.enrich(lang, *pairs[0])
+        await self.store(lang, level, self.usable([candidate]))
+        if len(pairs) > 1:
+            spawn_background(self.enrich_and_store(lang, level, pairs[1:]))
+        self.served += 1
+        return candidate
+
+    async def _load_counts(self):
+        rows = await self.db.fetchall("SELECT language, level, COUNT(*) FROM wod_pool GROUP BY language, level")
+        for lang, level, count in rows:
+            if (lang, level) in self.counts:
+                self.counts[(lang, level)] = count
+
+    async def _run(self):
+        await self._load_counts()
+        while not self._closing:
+            # Спочатку поповнюємо найпорожніші кошики та ті, що вичерпались для користувачів
+            now = time.monotonic()
+            todo = [b for b in self.buckets
+                    if (self.counts[b] < self.low or b in self._wanted) and self._retry_at.get(b, 0) <= now]
+            for lang, level in sorted(todo, key=lambda b: self.counts[b]):
+                self._wanted.discard((lang, level))
+                stored = 0
+                try:
+                    stored = await self.refill(lang, level)
+                except Exception as e:
+                    self.errors += 1
+                    print(f"Word of day pool error ({lang}, {level}): {e}")
+                self.schedule_retry((lang, level), stored)
+                await asyncio.sleep(WOD_PRODUCER_DELAY)
+
+            if not todo:
+                timeout = WOD_REFILL_INTERVAL
+                if self._retry_at:
+                    timeout = min(timeout, max(min(self._retry_at.values()) - time.monotonic(), WOD_PRODUCER_DELAY))
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+
+    def start(self):
+        if self._task is None and key_pool.keys:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        self._closing = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self):
+        return {
+            "served": self.served,
+            "user_cache_hits": self.user_cache_hits,
+            "pool_misses": self.pool_misses,
+            "batches": self.batches,
+            "generated": self.generated,
+            "degraded": self.degraded,
+            "errors": self.errors,
+            "budget_wait_s": round(self.budget_wait, 1),
+            "backoff_s": {f"{lang}/{lvl}": d for (lang, lvl), d in self._backoff.items()},
+            "buckets": {f"{lang}/{lvl}": n for (lang, lvl), n in self.counts.items()},
+        }
+
+
+wod_pool = WordOfDayPool(db, SUPPORTED_LANGUAGES, WOD_LEVELS)
+
+
 # Слово дня з ШІ
 @router.message(Command("word_of_day"))
 async def cmd_word_of_day(message: types.Message, state: FSMContext):
@@ -716,7 +3190,7 @@ async def cmd_word_of_day(message: types.Message, state: FSMContext):
     await message.answer("🌟 Оберіть мову для нового слова:", reply_markup=lang_kb)
 
 
-@router.message(WordOfDayState.waiting_for_language)
+@router.message(WordOfDayState.waiting_for_language, flags={"rate": "expensive"})
 async def process_word_of_day_lang(message: types.Message, state: FSMContext):
     lang = message.text.strip()
     user_id = message.from_user.id
@@ -729,54 +3203,35 @@ async def process_word_of_day_lang(message: types.Message, state: FSMContext):
         await message.answer("❌ Невідома мова. Виберіть зі списку.")
         return
 
-    await message.answer(f"⏳ Генерую слово ({lang})...")
-
-    lvl, _, _ = get_user_level_info(message.from_user.id)
-    diff = "A1" if lvl <= 3 else "B1" if lvl <= 8 else "C1"
-    user_words_list = get_user_words(message.from_user.id, lang)
-    existing_words = {w[0].lower() for w in user_words_list}
-
-    new_word = None
-    translation = None
-
-    
-    for i in range(3):
-        prompt = (
-            f"Згенеруй 1 (одне) цікаве слово мовою {lang} для рівня {diff}. "
-            f"Важливо: не повторюй ці слова: [{', '.join(list(existing_words)[-30:])}]. "
-            f"Формат відповіді суворо: 'Слово - Переклад'. Переклад українською. "
-            f"Без зайвого тексту."
-        )
-
-        response = await asyncio.to_thread(generate_content_safe, contents=prompt)
-        result = response.text.strip().replace("*", "")
-
-        if " - " in result:
-            w, t = result.split(" - ", 1)
-            w = w.strip()
-            if w.lower() not in existing_words:
-                new_word = w
-                translation = t.strip()
-                break
-        else:
-            continue
-
-    if not new_word:
-        await message.answer("⚠️ Не вдалося знайти нове унікальне слово.",
-                             reply_markup=get_main_kb(message.from_user.id))
-        await state.clear()
-        return
+    lvl, _, _ = await get_user_level_info(user_id)
+    diff = wod_difficulty(lvl)
+    # Не пропонуємо слова, які вже є у словнику або вже були показані в цій сесії
+    data = await state.get_data()
+    seen = set(data.get("wod_seen", []))
 
     try:
-        transc, assoc, visual_prompt = await get_full_word_info(new_word, translation, lang)
+        candidate = await wod_pool.next_for_user(user_id, lang, diff, seen)
+        if candidate is None:
+            # Пул для цього користувача вичерпано - генеруємо напряму
+            await message.answer(f"⏳ Генерую слово ({lang})...")
+            candidate = await wod_pool.generate_for_user(user_id, lang, diff, seen)
+
+        if not candidate:
+            await message.answer("⚠️ Не вдалося знайти нове унікальне слово.",
+                                 reply_markup=await get_main_kb(user_id))
+            await state.clear()
+            return
 
-        search_query = visual_prompt if visual_prompt else new_word
-        image_url = await get_image_url(search_query)
+        new_word = candidate["word"]
+        translation = candidate["translation"]
+        transc = candidate["transcription"]
+        image_url = candidate["image_url"]
 
         await state.update_data(
             new_word=new_word, translation=translation, lang=lang,
-            image_url=image_url, association=assoc, transcription=transc,
-            img_query=search_query  # Зберігаємо для регенерації
+            image_url=image_url, association=candidate["association"], transcription=transc,
+            img_query=candidate["img_query"],  # Зберігаємо для регенерації
+            wod_seen=list(seen | {new_word.lower()})
         )
 
         msg_text = f"🌟 Слово дня: <b>{new_word}</b> {transc}\n🇺🇦 Переклад: {translation}"
@@ -801,11 +3256,27 @@ async def process_word_of_day_lang(message: types.Message, state: FSMContext):
         await state.set_state(WordOfDayState.waiting_for_action)
 
     except Exception as e:
-        kb = get_main_kb(message.from_user.id)
+        kb = await get_main_kb(user_id)
         await message.answer(f"⚠️ Помилка: {e}", reply_markup=kb)
         await state.clear()
 
 
+# "Наступне слово" може генерувати слово через ШІ, тому має окремий (дорожчий) ліміт
+@router.message(WordOfDayState.waiting_for_action, F.text == "➡️ Наступне слово", flags={"rate": "expensive"})
+async def process_wod_next(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    # FIX: Використовуємо message.bot, оскільки bot більше не глобальний
+    msg = types.Message(
+        message_id=0,
+        date=datetime.now(),
+        chat=message.chat,
+        text=data.get('lang', 'English'),
+        from_user=message.from_user
+    ).as_(message.bot)
+
+    await process_word_of_day_lang(msg, state)
+
+
 @router.message(WordOfDayState.waiting_for_action)
 async def process_wod_action(message: types.Message, state: FSMContext):
     text = message.text
@@ -813,25 +3284,14 @@ async def process_wod_action(message: types.Message, state: FSMContext):
 
     if text == "🚪 Вихід":
         await cmd_exit(message, state)
-    elif text == "➡️ Наступне слово":
-        # FIX: Використовуємо message.bot, оскільки bot більше не глобальний
-        msg = types.Message(
-            message_id=0,
-            date=datetime.now(),
-            chat=message.chat,
-            text=data.get('lang', 'English'),
-            from_user=message.from_user
-        ).as_(message.bot)
-
-        await process_word_of_day_lang(msg, state)
     elif text == "➕ Додати це слово":
         word = data.get("new_word")
         if not word:
-            await message.answer("Дані застаріли.", reply_markup=get_main_kb(message.from_user.id))
+            await message.answer("Дані застаріли.", reply_markup=await get_main_kb(message.from_user.id))
             return
 
-        added = add_word_to_db(message.from_user.id, word, data['translation'], data['lang'], data['image_url'],
-                               data['association'], data['transcription'])
+        added = await add_word_to_db(message.from_user.id, word, data['translation'], data['lang'], data['image_url'],
+                                     data['association'], data['transcription'])
         if added:
             confirm = f"✅ Додано!\n🧠 {data['association']}" if data['association'] else "✅ Додано!"
             await message.answer(confirm)
@@ -845,27 +3305,20 @@ async def process_wod_action(message: types.Message, state: FSMContext):
 @router.message(Command("stats"))
 async def cmd_stats(message: types.Message):
     user_id = message.from_user.id
-    words = get_user_words(user_id)
-    total_words = len(words)
-    # Індекс 3 - usage_count
-    total_correct = sum([w[3] for w in words])
-    lvl, current_xp, next_xp = get_user_level_info(user_id)
+    # Готові агрегати по мовах: (language, word_count, total_xp, last_practiced)
+    rows = await get_user_stats(user_id)
+    total_words = sum(r[1] for r in rows)
+    total_correct = sum(r[2] for r in rows)
+    lvl, current_xp, next_xp = level_from_xp(total_correct)
 
     percent = int((current_xp / next_xp) * 10)
     bar = "🟩" * percent + "⬜" * (10 - percent)
 
     # Статистика по мовах
-    lang_stats = {}
-    for w in words:
-        l = w[2]
-        if l not in lang_stats:
-            lang_stats[l] = 0
-        lang_stats[l] += 1
+    lang_stats = {r[0]: r[1] for r in rows}
 
     # Рекорд гри
-    cursor.execute("SELECT best_score FROM users WHERE user_id=?", (user_id,))
-    res = cursor.fetchone()
-    best_game_score = res[0] if res else 0
+    best_game_score = await get_best_score(user_id)
 
     stats_text = f"📊 <b>Статистика</b>\n" \
                  f"🏆 Рівень: {lvl}\n" \
@@ -879,25 +3332,23 @@ async def cmd_stats(message: types.Message):
     for lang, count in lang_stats.items():
         stats_text += f"- {lang}: {count} сл.\n"
 
-    await message.answer(stats_text, reply_markup=get_main_kb(user_id), parse_mode="HTML")
+    await message.answer(stats_text, reply_markup=await get_main_kb(user_id), parse_mode="HTML")
 
 
 # Режим практики
 @router.message(Command("practice"))
 async def cmd_practice(message: types.Message, state: FSMContext):
-    words = get_user_words(message.from_user.id)
-    if not words:
+    languages = await get_user_languages(message.from_user.id)
+    if not languages:
         await message.answer("📭 Ваш словник порожній. Додайте слова через /add_word.",
-                             reply_markup=get_main_kb(message.from_user.id))
+                             reply_markup=await get_main_kb(message.from_user.id))
         return
 
-    languages = sorted(list(set([w[2] for w in words if w[2] is not None])))
     keyboard = [[types.KeyboardButton(text=l)] for l in languages]
     keyboard.append([types.KeyboardButton(text="Усі мови")])
     keyboard.append([types.KeyboardButton(text="/exit")])
     lang_kb = types.ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True, one_time_keyboard=True)
 
-    await state.update_data(all_practice_words=words)
     await state.set_state(PracticeWord.waiting_for_language)
     await message.answer("🎯 Оберіть мову для практики (або 'Усі мови'):", reply_markup=lang_kb)
 
@@ -912,18 +3363,14 @@ async def practice_choose_lang(message: types.Message, state: FSMContext):
         await cmd_exit(message, state)
         return
 
-    data = await state.get_data()
-    all_words = data.get("all_practice_words", [])
-
-    if text == "Усі мови":
-        target = all_words
-    else:
-        target = [w for w in all_words if w[2] == text]
+    # Слова, які найдовше чекають повторення (якщо таких мало - ті, що на черзі наступними)
+    target = await get_due_words(message.from_user.id, None if text == "Усі мови" else text)
 
     if not target: await message.answer("Пусто."); return
 
     random.shuffle(target)
-    await state.update_data(plist=target[:10], pidx=0)
+    # У стані зберігаємо лише ключі слів та позицію, самі рядки читаємо з БД по мірі потреби
+    await state.update_data(plist=[[w[0], w[2]] for w in target], pidx=0)
     await state.set_state(PracticeWord.waiting_for_answer)
     await send_practice_q(message, target[0])
 
@@ -941,35 +3388,49 @@ async def send_practice_q(message, w):
 @router.message(PracticeWord.waiting_for_answer)
 async def process_practice_ans(message: types.Message, state: FSMContext):
     if message.text == "/exit": await cmd_exit(message, state); return
+    user_id = message.from_user.id
     data = await state.get_data()
     p_list = data['plist']
     idx = data['pidx']
 
-    correct_word = p_list[idx][0]
+    w = await get_practice_word(user_id, *p_list[idx])
+    if w:
+        correct_word = w[0]
+        correct = message.text.lower() == correct_word.lower()
+        # 7-ease, 8-interval, 9-reps
+        record_review(user_id, correct_word, w[2], w[7], w[8], w[9], correct)
 
-    if message.text.lower() == correct_word.lower():
-        increment_usage_count(message.from_user.id, correct_word)
-        await message.answer(f"✅ Правильно! {correct_word}")
-    else:
-        # 5-assoc, 6-transc
-        hint = f"\n💡 {p_list[idx][5]}" if p_list[idx][5] else ""
-        tr = f" {p_list[idx][6]}" if p_list[idx][6] else ""
-        await message.answer(f"❌ Ні. {correct_word}{tr}{hint}")
+        if correct:
+            increment_usage_count(user_id, correct_word)
+            await message.answer(f"✅ Правильно! {correct_word}")
+        else:
+            # 5-assoc, 6-transc
+            hint = f"\n💡 {w[5]}" if w[5] else ""
+            tr = f" {w[6]}" if w[6] else ""
+            await message.answer(f"❌ Ні. {correct_word}{tr}{hint}")
 
+    # Наступне слово (пропускаємо ті, що встигли видалити зі словника)
     idx += 1
-    if idx >= len(p_list):
-        await message.answer("🏁 Кінець тренування.", reply_markup=get_main_kb(message.from_user.id))
+    next_w = None
+    while idx < len(p_list):
+        next_w = await get_practice_word(user_id, *p_list[idx])
+        if next_w:
+            break
+        idx += 1
+
+    if not next_w:
+        await message.answer("🏁 Кінець тренування.", reply_markup=await get_main_kb(user_id))
         await state.clear()
     else:
         await state.update_data(pidx=idx)
-        await send_practice_q(message, p_list[idx])
+        await send_practice_q(message, next_w)
 
 
 # Початок процесу видалення слова
 @router.message(Command("delete_word"))
 async def cmd_delete_word(message: types.Message, state: FSMContext):
     update_last_active(message.from_user.id)
-    kb = get_main_kb(message.from_user.id)
+    kb = await get_main_kb(message.from_user.id)
     await state.set_state(DeleteWord.waiting_for_word)
     await message.answer("🗑️ Введіть слово для видалення (або /exit):", reply_markup=kb)
 
@@ -985,13 +3446,13 @@ async def process_delete_word(message: types.Message, state: FSMContext):
         await cmd_exit(message, state)
         return
 
-    words_in_db = [w[0] for w in get_user_words(user_id)]
+    words_in_db = [w[0] for w in await get_user_words(user_id)]
 
     if text in words_in_db:
-        delete_word_from_db(user_id, text)
-        await message.answer(f"🗑️ Слово '{text}' видалено.", reply_markup=get_main_kb(user_id))
+        await delete_word_from_db(user_id, text)
+        await message.answer(f"🗑️ Слово '{text}' видалено.", reply_markup=await get_main_kb(user_id))
     else:
-        await message.answer(f"❌ Слова '{text}' немає в словнику.", reply_markup=get_main_kb(user_id))
+        await message.answer(f"❌ Слова '{text}' немає в словнику.", reply_markup=await get_main_kb(user_id))
 
 
 # Початок перегляду всіх слів
@@ -999,9 +3460,9 @@ async def process_delete_word(message: types.Message, state: FSMContext):
 async def cmd_all_words(message: types.Message, state: FSMContext):
     update_last_active(message.from_user.id)
     user_id = message.from_user.id
-    words = get_user_words(user_id)
+    words = await get_user_words(user_id)
     if not words:
-        await message.answer("📭 Ваш словник порожній.", reply_markup=get_main_kb(user_id))
+        await message.answer("📭 Ваш словник порожній.", reply_markup=await get_main_kb(user_id))
         return
 
     # Оновлено: використовуємо індекс 2 для мови (language)
@@ -1009,7 +3470,7 @@ async def cmd_all_words(message: types.Message, state: FSMContext):
 
     if not languages:
         words_list = "\n".join([f"{w[0]} — {w[1]}" for w in words])
-        await message.answer(f"📝 Ваші слова:\n{words_list}", reply_markup=get_main_kb(user_id))
+        await message.answer(f"📝 Ваші слова:\n{words_list}", reply_markup=await get_main_kb(user_id))
         return
 
     keyboard = [[types.KeyboardButton(text=l)] for l in languages]
@@ -1032,12 +3493,12 @@ async def process_view_language(message: types.Message, state: FSMContext):
         return
 
     if lang_choice == "Усі мови":
-        words = get_user_words(user_id)
+        words = await get_user_words(user_id)
     else:
-        words = get_user_words(user_id, language=lang_choice)
+        words = await get_user_words(user_id, language=lang_choice)
 
     if not words:
-        await message.answer("📭 Словник порожній.", reply_markup=get_main_kb(user_id))
+        await message.answer("📭 Словник порожній.", reply_markup=await get_main_kb(user_id))
     else:
         text = f"📝 Слова ({lang_choice}):\n"
         for w in words:
@@ -1046,9 +3507,9 @@ async def process_view_language(message: types.Message, state: FSMContext):
             text += f"{w[0]}{transc_str} — {w[1]}\n"
 
         if len(text) > 4096:
-            await message.answer(f"📝 Слова ({lang_choice}):\n... (занадто багато)", reply_markup=get_main_kb(user_id))
+            await message.answer(f"📝 Слова ({lang_choice}):\n... (занадто багато)", reply_markup=await get_main_kb(user_id))
         else:
-            await message.answer(text, reply_markup=get_main_kb(user_id))
+            await message.answer(text, reply_markup=await get_main_kb(user_id))
 
     await state.clear()
 
@@ -1057,7 +3518,7 @@ async def process_view_language(message: types.Message, state: FSMContext):
 @router.message(Command("AI"))
 async def cmd_ai(message: types.Message, state: FSMContext):
     await state.set_state(AIHelper.waiting_for_prompt)
-    await message.answer("🤖 Введіть слово для пояснення:", reply_markup=get_main_kb(message.from_user.id))
+    await message.answer("🤖 Введіть слово для пояснення:", reply_markup=await get_main_kb(message.from_user.id))
 
 
 # Отримання запиту для ШІ
@@ -1085,7 +3546,7 @@ async def process_ai_prompt(message: types.Message, state: FSMContext):
 
 
 # Обробка мови запиту та отримання відповіді від ШІ
-@router.message(AIHelper.waiting_for_language)
+@router.message(AIHelper.waiting_for_language, flags={"rate": "expensive"})
 async def process_ai_language(message: types.Message, state: FSMContext):
     language_of_word = message.text.strip()
 
@@ -1096,7 +3557,7 @@ async def process_ai_language(message: types.Message, state: FSMContext):
     data = await state.get_data()
     prompt = data.get("prompt")
 
-    await message.answer("🤖 Оброблюю...", reply_markup=get_main_kb(message.from_user.id))
+    await message.answer("🤖 Оброблюю...", reply_markup=await get_main_kb(message.from_user.id))
 
     try:
         txt, img = await asyncio.gather(
@@ -1119,10 +3580,21 @@ async def process_ai_language(message: types.Message, state: FSMContext):
             await message.answer(f"🤖 Ось пояснення:\n\n{txt}", reply_markup=inline_regen)
 
     except Exception as e:
-        await message.answer(f"{str(e)}", reply_markup=get_main_kb(message.from_user.id))
+        await message.answer(f"{str(e)}", reply_markup=await get_main_kb(message.from_user.id))
 
     await state.set_state(AIHelper.waiting_for_prompt)
-    await message.answer("🤖 Ще слово? (або /exit)", reply_markup=get_main_kb(message.from_user.id))
+    await message.answer("🤖 Ще слово? (або /exit)", reply_markup=await get_main_kb(message.from_user.id))
+
+
+# Зовнішній сервіс перевантажений і обробник не перехопив помилку - швидко відповідаємо користувачу
+@router.errors(ExceptionTypeFilter(UpstreamBusy))
+async def upstream_busy_handler(event: types.ErrorEvent):
+    update = event.update
+    if update.message:
+        await update.message.answer(str(event.exception))
+    elif update.callback_query:
+        await update.callback_query.answer(str(event.exception), show_alert=True)
+    return True
 
 
 # Обробник невідомих команд або тексту
@@ -1134,30 +3606,331 @@ async def unknown_command(message: types.Message, state: FSMContext):
             "❌ Незрозуміла відповідь. Будь ласка, дотримуйтесь інструкцій або натисніть /exit, щоб вийти з поточного режиму.")
         return
 
-    await message.answer("❌ Невідома команда.\n" + COMMANDS_TEXT, reply_markup=get_main_kb(message.from_user.id))
+    await message.answer("❌ Невідома команда.\n" + COMMANDS_TEXT, reply_markup=await get_main_kb(message.from_user.id))
 
 
 # Запуск бота (Виправлено: створення Bot і Dispatcher всередині main)
-async def main():
-    print("Бота запущено")
-    
-    # 1. Ініціалізуємо бота та диспетчера ТУТ, всередині циклу подій
+# Метрики компонентів, що зчитуються в момент запиту /metrics
+metrics.collect("bot_cache_hits_total", "Влучання в кеші", "counter", lambda: {
+    "pixabay": image_search.hits,
+    "word_info_memory": word_info_cache.memory_hits,
+    "word_info_db": word_info_cache.db_hits,
+    "translator_memory": translation_service.memory_hits,
+    "translator_db": translation_service.db_hits,
+    "fsm": fsm_storage.hits,
+}, ("cache",))
+metrics.collect("bot_cache_misses_total", "Промахи кешів", "counter", lambda: {
+    "pixabay": image_search.misses,
+    "word_info": word_info_cache.misses,
+    "translator": translation_service.misses,
+    "fsm": fsm_storage.misses,
+}, ("cache",))
+metrics.collect("bot_cache_hit_ratio", "Частка влучань у кеш", "gauge", lambda: {
+    "pixabay": image_search.stats()["hit_ratio"],
+    "word_info": word_info_cache.stats()["hit_ratio"],
+    "translator": translation_service.stats()["hit_ratio"],
+}, ("cache",))
+metrics.collect("bot_gemini_key_rotations_total", "Скільки разів ключ Gemini пішов на охолодження", "counter",
+                lambda: key_pool.rotations)
+metrics.collect("bot_gemini_key_requests_total", "Запити по кожному ключу Gemini", "counter",
+                lambda: {k.index + 1: k.requests for k in key_pool.keys}, ("key",))
+metrics.collect("bot_upstream_in_flight", "Запити до сервісу, що виконуються зараз", "gauge",
+                lambda: {g.name: g.in_flight for g in AdmissionGate.registry}, ("upstream",))
+metrics.collect("bot_upstream_waiting", "Запити в черзі до сервісу", "gauge",
+                lambda: {g.name: g.waiting for g in AdmissionGate.registry}, ("upstream",))
+metrics.collect("bot_single_flight_coalesced_total", "Об'єднані однакові запити", "counter",
+                lambda: {f.name: f.coalesced for f in SingleFlight.registry}, ("flight",))
+metrics.collect("bot_write_buffer_depth", "Записів у буфері відкладеного запису", "gauge",
+                lambda: write_buffer.queue_depth)
+metrics.collect("bot_throttled_total", "Повідомлення, обмежені антиспамом", "counter", lambda: {
+    (name, outcome): value for name, c in throttling.counters.items() for outcome, value in c.items()
+}, ("limit", "outcome"))
+metrics.collect("bot_wod_pool_served_total", "Слова дня, видані з пулу", "counter", lambda: wod_pool.served)
+metrics.collect("bot_game_results_depth", "Результати гри в черзі на запис", "gauge",
+                lambda: game_results.queue.qsize())
+
+
+# ЗАПУСК
+def create_dispatcher():
     bot = Bot(token=TELEGRAM_BOT_TOKEN)
-    dp = Dispatcher()
-    
-    # 2. Підключаємо наш Router
+    dp = Dispatcher(storage=fsm_storage)
     dp.include_router(router)
+    dp.message.middleware(throttling)
+    dp.message.middleware(handler_metrics)
+    dp.callback_query.middleware(handler_metrics)
+    return bot, dp
+
+
+# Фонові задачі процесу, що обробляє оновлення (відкладений запис у БД, кеші, пул "Слова дня")
+async def start_services(run_producer=True):
+    asyncio.create_task(loop_lag_monitor())
+    write_buffer.start()
+    fsm_storage.start()
+    await image_search.start()
+    asyncio.create_task(word_info_cache.warm_up(WORD_INFO_WARMUP))
+    if run_producer:
+        wod_pool.start()
+        asyncio.create_task(game_results_pruner())
+
+
+async def stop_services():
+    # Записуємо в БД усе, що ще лежить у буфері
+    await drain_background()
+    await wod_pool.close()
+    await game_results.close()
+    await fsm_storage.close()
+    await write_buffer.close()
+    await image_search.close()
+    translation_service.close()
+    db.close()
+
+
+# КІЛЬКА ПРОЦЕСІВ
+# Один процес (приймач) отримує оновлення і розподіляє їх за id користувача між BOT_WORKERS
+# процесами-обробниками. Користувач завжди потрапляє в той самий процес, тому порядок його
+# повідомлень, стан FSM і антиспам залишаються узгодженими.
+POLL_TIMEOUT = 30  # секунд long polling у getUpdates
+WORKER_CHECK_INTERVAL = 5  # як часто перевіряти, чи живі процеси-обробники
+
+
+class ProcessRouter:
+    def __init__(self, queues):
+        self.queues = queues
+        self.accepted = 0
+        self.rejected = 0
+
+    def _queue(self, update):
+        return self.queues[hash(update_user_id(update)) % len(self.queues)]
+
+    def submit(self, update):
+        try:
+            self._queue(update).put_nowait(update)
+        except Full:
+            self.rejected += 1
+            return False
+        self.accepted += 1
+        return True
+
+    async def put(self, update):
+        queue = self._queue(update)
+        while True:
+            try:
+                queue.put_nowait(update)
+                break
+            except Full:
+                await asyncio.sleep(0.05)
+        self.accepted += 1
+
+    def stats(self):
+        try:
+            depth = [q.qsize() for q in self.queues]
+        except NotImplementedError:  # macOS
+            depth = None
+        return {"accepted": self.accepted, "rejected": self.rejected, "queue_depth": depth}
+
+
+def worker_process(index, queue):
+    # Сигнал зупинки обробляє приймач: він надсилає кожному обробнику маркер None, і той завершується,
+    # дописавши свої черги. Сигнал, надісланий усій групі процесів, не повинен обривати обробник раніше
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        asyncio.run(run_worker(index, queue))
+    except KeyboardInterrupt:
+        pass
+
+
+async def run_worker(index, queue):
+    bot, dp = create_dispatcher()
+    shards = UpdateShards(dp, bot)
+    # "Слово дня" генерує лише перший процес, решта беруть слова з готового пулу
+    await start_services(run_producer=index == 0)
+    # Кожен обробник віддає свої /status і /metrics на окремому порту: PORT+1, PORT+2, ...
+    await start_web_server(updates=shards, port=int(os.environ.get("PORT", 8080)) + 1 + index)
+    shards.start()
+    await dp.emit_startup(bot=bot)
+    print(f"⚙️ Процес-обробник {index} запущено")
+
+    loop = asyncio.get_running_loop()
+    parent = multiprocessing.parent_process()
+    try:
+        while True:
+            try:
+                update = await loop.run_in_executor(None, functools.partial(queue.get, timeout=1))
+            except Empty:
+                # Приймач завершився без сигналу зупинки - зупиняємось і ми
+                if parent is not None and not parent.is_alive():
+                    break
+                continue
+            if update is None:
+                break
+            await shards.put(update)
+    finally:
+        await shards.close()
+        await drain_background()
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+        await stop_services()
+
+
+class WorkerSupervisor:
+    def __init__(self, count, queue_size=WEBHOOK_QUEUE_SIZE):
+        self.ctx = multiprocessing.get_context("spawn")
+        self.queues = [self.ctx.Queue(maxsize=queue_size) for _ in range(count)]
+        self.processes = [None] * count
+        self.router = ProcessRouter(self.queues)
+        self.restarts = 0
+        self._task = None
+
+    def _spawn(self, index):
+        process = self.ctx.Process(target=worker_process, args=(index, self.queues[index]),
+                                   name=f"bot-worker-{index}")
+        process.start()
+        self.processes[index] = process
+
+    async def _watch(self):
+        # Перезапускаємо процес, якщо він впав (його черга зберігається)
+        while True:
+            await asyncio.sleep(WORKER_CHECK_INTERVAL)
+            for index, process in enumerate(self.processes):
+                if not process.is_alive():
+                    print(f"⚠️ Процес-обробник {index} завершився (код {process.exitcode}), перезапускаємо")
+                    self.restarts += 1
+                    self._spawn(index)
+
+    def start(self):
+        for index in range(len(self.queues)):
+            self._spawn(index)
+        self._task = asyncio.create_task(self._watch())
+
+    async def close(self, timeout=15):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        loop = asyncio.get_running_loop()
+        # None - сигнал зупинки: обробник дочитує свою чергу, скидає буфери і виходить
+        for queue in self.queues:
+            try:
+                await loop.run_in_executor(None, functools.partial(queue.put, None, timeout=timeout))
+            except Full:
+                pass
+        for process in self.processes:
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                process.terminate()
+
+    def stats(self):
+        return {
+            "processes": len(self.processes),
+            "alive": sum(1 for p in self.processes if p is not None and p.is_alive()),
+            "restarts": self.restarts,
+            **self.router.stats(),
+        }
+
+
+# Приймання оновлень через getUpdates у режимі з кількома процесами
+# Подія зупинки за SIGTERM/SIGINT. Хостинг надсилає SIGTERM перед перезапуском; без обробника процес
+# завершується одразу, і блоки finally (скидання буферів, станів FSM, черги результатів) не виконуються
+def stop_event_on_signals():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows не підтримує обробники сигналів у циклі подій
+            pass
+    return stop
+
+
+async def poll_updates(bot, sink, allowed_updates):
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=POLL_TIMEOUT, allowed_updates=allowed_updates,
+                                            request_timeout=POLL_TIMEOUT + 10)
+        except Exception as e:
+            print(f"Error in get_updates: {e}")
+            await asyncio.sleep(5)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            await sink.put(update.model_dump(mode="json", exclude_none=True, by_alias=True))
+
+
+async def run_supervisor(bot, dp):
+    supervisor = WorkerSupervisor(BOT_WORKERS)
+    supervisor.start()
+    webhook = QueuedRequestHandler(dp, bot, WEBHOOK_SECRET, supervisor.router) if WEBHOOK_URL else None
+    await start_web_server(webhook, supervisor)
+    asyncio.create_task(keep_alive_task())
+    asyncio.create_task(loop_lag_monitor())
+    print(f"🧩 Запущено процесів-обробників: {BOT_WORKERS}")
+
+    stop = stop_event_on_signals()
+    try:
+        if webhook is not None:
+            # Оновлення, що надійшли під час перезапуску, Telegram доставить після встановлення вебхука
+            await bot.set_webhook(WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                                  allowed_updates=dp.resolve_used_update_types())
+            print(f"🔗 Вебхук встановлено: {WEBHOOK_URL + WEBHOOK_PATH}")
+            await stop.wait()
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            poller = asyncio.create_task(poll_updates(bot, supervisor.router, dp.resolve_used_update_types()))
+            stopper = asyncio.create_task(stop.wait())
+            await asyncio.wait((poller, stopper), return_when=asyncio.FIRST_COMPLETED)
+            poller.cancel()
+            stopper.cancel()
+        print("🛑 Зупинка: чекаємо завершення процесів-обробників")
+    finally:
+        await game_results.close()
+        await supervisor.close()
+        await bot.session.close()
+        db.close()
+
+
+async def main():
+    print("Бота запущено")
     
-    # 3. Підключаємо Middleware
-    dp.message.middleware(ThrottlingMiddleware(throttle_time=1))
+    # 1. Ініціалізуємо бота та диспетчера ТУТ, всередині циклу подій (Router + Middleware)
+    bot, dp = create_dispatcher()
+
+    # 2. Режим з кількома процесами: цей процес лише приймає і розподіляє оновлення
+    if BOT_WORKERS > 1:
+        await run_supervisor(bot, dp)
+        return
 
-    # 4. Запускаємо фонові задачі (веб-сервер та пінгувальник)
-    asyncio.create_task(start_web_server())
+    # 3. Запускаємо фонові задачі (веб-сервер, пінгувальник, відкладений запис у БД)
+    shards = UpdateShards(dp, bot) if WEBHOOK_URL else None
+    webhook = QueuedRequestHandler(dp, bot, WEBHOOK_SECRET, shards) if WEBHOOK_URL else None
+    await start_web_server(webhook, shards)
     asyncio.create_task(keep_alive_task())
+    await start_services()
     
-    # 5. Очищаємо вебхук і запускаємо поллінг
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    # 4. Вебхук (якщо налаштований) або поллінг
+    try:
+        if webhook is not None:
+            stop = stop_event_on_signals()
+            shards.start()
+            await dp.emit_startup(bot=bot)
+            # Оновлення, що надійшли під час перезапуску, Telegram доставить після встановлення вебхука
+            await bot.set_webhook(WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                                  allowed_updates=dp.resolve_used_update_types())
+            print(f"🔗 Вебхук встановлено: {WEBHOOK_URL + WEBHOOK_PATH}")
+            await stop.wait()
+            print("🛑 Зупинка: дописуємо чергу оновлень і буфери")
+        else:
+            # start_polling сам обробляє SIGTERM/SIGINT і повертає керування в finally
+            await bot.delete_webhook(drop_pending_updates=True)
+            await dp.start_polling(bot)
+    finally:
+        if webhook is not None:
+            await shards.close()
+            await drain_background()
+            await dp.emit_shutdown(bot=bot)
+            await bot.session.close()
+        await stop_services()
 
 
 if __name__ == "__main__":